@@ -1,172 +1,363 @@
-import sqlite3
 import os
 import logging
-import io
 import json
 from hashlib import md5
-from tempfile import NamedTemporaryFile
-from Crypto.Cipher import Blowfish
-from Crypto.Util.Padding import unpad, pad
 import zipfile
-from urllib.parse import unquote, urlparse, parse_qs
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import lru_cache
+from array import array
+from collections.abc import Mapping, Sequence
+from sys import intern
+from urllib.parse import quote, unquote, urlparse, parse_qs
+
+# sqlite3, pycryptodome, tempfile, shutil and concurrent.futures are imported where they are used,
+# they are slow to import and a lot of commands don't need them (print -a only needs the zip)
 
 logger = logging.getLogger(__name__)
 
 
-class MusicoletBackup:
-    def __init__(self, backup_path: str):
-        def __decrypt_file(data: bytes) -> bytes:
-            # key from /u/wrr666: https://www.reddit.com/r/androidapps/comments/t9zwow/musicolet_reading_backup/
-            # krosbits, WHY, just WHY is the backup encrypted???
-            key = "JSTMUSIC_2"
-            # => Blowfish cipher in ECB mode
-            cipher = Blowfish.new(bytes(key, "utf-8"), Blowfish.MODE_ECB)
-
-            data_decrypted = cipher.decrypt(data)
-            # remove padding (internet said to do it, idk)
-            data_decrypted = unpad(data_decrypted, Blowfish.block_size)
-            return data_decrypted
-
-        # we can decrypt all files from the zip
-        with zipfile.ZipFile(backup_path, "r") as zipbackup:
-            decr_files = {}
-            namelist = zipbackup.namelist()
-            for name in namelist:
-                try:
-                    decr_data = __decrypt_file(zipbackup.open(name).read())
-                except ValueError as e:
-                    # note: the hash file is the only one that should fail,
-                    # it is not encrypted, it is the md5 hash of the unencrypted "0.musicolet.backup" file
-                    logger.error(f"Decryption failed for file '{name}': {e}")
-                    continue
-
-                logger.debug(f"Decrypted '{name}' successfully.")
-                decr_files[name] = decr_data
-            self.backup = decr_files
-
-        self.__maindb_file = NamedTemporaryFile()
-        self.__maindb_file.write(self.backup["DB_SONGS_LOG"])
-        self.__maindb_conn = sqlite3.connect(self.__maindb_file.name)
-        self.__maindb_conn.row_factory = sqlite3.Row
-        self.__maindb_cursor = self.__maindb_conn.cursor()
-
-    def __del__(self):
-        logger.debug("deleted object, closing temporary files...")
-        self.__maindb_file.close()
-
-    @staticmethod
-    def encrypt_backup(dirpath: str, outpath: str):
-        """This function can be used to create a valid Musicolet backup zip from a decrypted
-        backup. Note: for now it does NOT support adding files to the backup!!
-
-        Args:
-            dirpath (str): path of the decrypted backup dir
-            outpath (str): path of the zip
-        """
+# key from /u/wrr666: https://www.reddit.com/r/androidapps/comments/t9zwow/musicolet_reading_backup/
+# krosbits, WHY, just WHY is the backup encrypted???
+BACKUP_KEY = "JSTMUSIC_2"
+BLOCK_SIZE = 8  # Blowfish block size
+# must be a multiple of the Blowfish block size
+ENCRYPTION_CHUNK_SIZE = 1024 * 1024
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
 
-        def __encrypt_file(data: bytes) -> bytes:
-            key = "JSTMUSIC_2"
-            cipher = Blowfish.new(bytes(key, "utf-8"), Blowfish.MODE_ECB)
-            return cipher.encrypt(pad(data, Blowfish.block_size))
+# sort keys for MusicoletBackup.iter_top_songs(), "time" accounts for the length of the songs
+TOP_SONGS_ORDER = {
+    "plays": '"COL_NUM_PLAYED"',
+    "plays_year": '"COL_NUM_PLAYED_Y"',
+    "plays_month": '"COL_NUM_PLAYED_M"',
+    "plays_week": '"COL_NUM_PLAYED_W"',
+    "time": '("COL_NUM_PLAYED" * "COL_DURATION")',
+    "time_year": '("COL_NUM_PLAYED_Y" * "COL_DURATION")',
+    "time_month": '("COL_NUM_PLAYED_M" * "COL_DURATION")',
+    "time_week": '("COL_NUM_PLAYED_W" * "COL_DURATION")',
+}
 
-        bck_files = {}
 
-        for root, _, files in os.walk(dirpath):
-            if "0.musicolet.backup" not in files:
-                raise Exception("there is no '0.musicolet.backup' file!")
+def _cipher():
+    from Crypto.Cipher import Blowfish
 
-            for file in files:
-                filepath = os.path.join(root, file)
-                relpath = os.path.relpath(filepath, dirpath)
+    # => Blowfish cipher in ECB mode
+    return Blowfish.new(bytes(BACKUP_KEY, "utf-8"), Blowfish.MODE_ECB)
 
-                with open(filepath, "rb") as f:
-                    data = f.read()
 
-                if file != "0.musicolet.backup":
-                    logger.debug(f"adding {file} in the dict")
-                    bck_files[relpath] = {"data": data, "md5": md5(data).hexdigest()}
-                else:
-                    backup_file = json.loads(data)
+def _decrypt_file(data: bytes) -> bytes:
+    from Crypto.Util.Padding import unpad
 
-        # preparing the "0.musicolet.backup" file
-        for file in backup_file["md5"].keys():
-            # replace all md4 in the "0.musicolet.backup" file with the newly calculated ones
+    data_decrypted = _cipher().decrypt(data)
+    # remove padding (internet said to do it, idk)
+    data_decrypted = unpad(data_decrypted, BLOCK_SIZE)
+    return data_decrypted
+
+
+def _encrypt_file(data: bytes) -> bytes:
+    from Crypto.Util.Padding import pad
+
+    return _cipher().encrypt(pad(data, BLOCK_SIZE))
+
+
+def _try_decrypt_file(data: bytes) -> tuple:
+    """Worker for the process pool, returns (decrypted data, None) or (None, error message)"""
+    try:
+        return _decrypt_file(data), None
+    except ValueError as e:
+        return None, str(e)
+
+
+def _encrypt_chunk(item: tuple) -> tuple:
+    """Worker for the process pool, encrypts one chunk of a file.
+    ECB encrypts every block on its own so chunks (multiple of the block size)
+    can be encrypted separately, only the last one of a file is padded.
+    """
+    from Crypto.Util.Padding import pad
+
+    name, data, last = item
+    return name, _cipher().encrypt(pad(data, BLOCK_SIZE) if last else data), last
+
+
+def _map(fn, iterable, jobs: int = 1):
+    """Ordered map() that runs on a process pool when jobs > 1.
+    Only a few items are in flight at a time so big backups don't end up all in memory.
+    """
+    if jobs <= 1:
+        yield from map(fn, iterable)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def default_cache_dir() -> str:
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "musicolet-tools"
+    )
+
+
+def default_socket_path() -> str:
+    # used by mscltserve, it lives here so the CLI can know it without importing the server
+    return os.path.join(
+        os.environ.get("XDG_RUNTIME_DIR") or os.environ.get("TMPDIR") or "/tmp",
+        # no getuid() on windows, there is no unix socket there anyway
+        f"musicolet-tools-{getattr(os, 'getuid', lambda: 0)()}.sock",
+    )
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    from tempfile import mkstemp
+
+    # write to a temporary file next to the destination so concurrent runs never see half a file
+    fd, tmp = mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def prune_cache(cache_dir: str, max_size: int, keep: str = None) -> None:
+    """Removes the least recently used cache entries until the cache is smaller than max_size bytes.
+
+    Args:
+        cache_dir (str): cache root, one subdirectory per backup
+        max_size (int): size limit in bytes
+        keep (str): name of an entry that must not be removed (the one in use)
+    """
+    import shutil
+
+    entries = []
+    total = 0
+    for entry in os.scandir(cache_dir):
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+        size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+        entries.append((entry.stat().st_mtime, size, entry))
+        total += size
+
+    # oldest first, the entry mtime is updated every time the entry is used
+    for _, size, entry in sorted(entries, key=lambda e: e[0]):
+        if total <= max_size:
+            break
+        if entry.name == keep:
+            continue
+        logger.debug(f"Evicting cache entry '{entry.path}' ({size} bytes)")
+        shutil.rmtree(entry.path, ignore_errors=True)
+        total -= size
+
+
+class LazyBackupMembers(Mapping):
+    """Read-only mapping of the backup members, a member is only decrypted when it is accessed.
+    The index comes from the zip namelist, decrypted payloads are kept in a bounded LRU.
+    """
+
+    def __init__(self, backup_path: str, max_cached: int = 16, cache_dir: str = None):
+        self.__zip = zipfile.ZipFile(backup_path, "r")
+        # dict to keep the zip order
+        self.__index = dict.fromkeys(self.__zip.namelist())
+        self.__cache = OrderedDict()
+        self.__max_cached = max_cached
+        self.__lock = threading.Lock()
+
+        self.cache_entry = None
+        if cache_dir is not None:
             try:
-                backup_file["md5"][file] = bck_files[file]["md5"]
-            except KeyError:
-                raise Exception(
-                    f"File '{file}' is present in '0.musicolet.backup' but not in the dir!"
-                )
-
-        with zipfile.ZipFile(outpath, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for file in bck_files.keys():
-                logger.debug(f"adding {file} in the {outpath} zipfile.")
-                zipf.writestr(file, __encrypt_file(bck_files[file]["data"]))
+                self.cache_entry = os.path.join(cache_dir, self.__cache_key(backup_path))
+                os.makedirs(self.cache_entry, mode=0o700, exist_ok=True)
+                # mark the entry as recently used for the LRU eviction
+                os.utime(self.cache_entry)
+            except OSError as e:
+                logger.warning(f"Cache disabled, can't use '{cache_dir}': {e}")
+                self.cache_entry = None
+
+    def __cache_key(self, backup_path: str) -> str:
+        # the hash member is the md5 of "0.musicolet.backup", which has the md5 of every other file
+        if "hash" in self.__index:
+            digest = self.__zip.read("hash").decode("utf-8", "replace").strip()
+            if digest.isalnum():
+                return f"hash-{digest}"
+
+        # no usable hash, fallback to the zip itself
+        stat = os.stat(backup_path)
+        key = f"{os.path.abspath(backup_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        return f"stat-{md5(key.encode('utf-8')).hexdigest()}"
+
+    def cache_path(self, name: str) -> str:
+        """Path of the decrypted member in the on-disk cache, None if the cache is disabled"""
+        if self.cache_entry is None:
+            return None
+        return os.path.join(self.cache_entry, quote(name, safe=""))
+
+    def __getitem__(self, name: str) -> bytes:
+        with self.__lock:
+            if name in self.__cache:
+                self.__cache.move_to_end(name)
+                return self.__cache[name]
+
+        if name not in self.__index:
+            raise KeyError(name)
+
+        cache_path = self.cache_path(name)
+        if cache_path is not None and os.path.exists(cache_path):
+            logger.debug(f"Reading '{name}' from the cache.")
+            with open(cache_path, "rb") as f:
+                data = f.read()
+        else:
+            # decrypting outside of the lock, reading the zip is thread safe
+            try:
+                data = _decrypt_file(self.__zip.read(name))
+            except ValueError as e:
+                # note: the hash file is the only one that should fail,
+                # it is not encrypted, it is the md5 hash of the unencrypted "0.musicolet.backup" file
+                logger.error(f"Decryption failed for file '{name}': {e}")
+                # drop it from the index so it behaves like before (not in the backup)
+                self.__index.pop(name, None)
+                raise KeyError(name) from e
+
+            logger.debug(f"Decrypted '{name}' successfully.")
+            if cache_path is not None:
+                try:
+                    _atomic_write(cache_path, data)
+                except OSError as e:
+                    logger.warning(f"Could not write '{name}' in the cache: {e}")
+
+        with self.__lock:
+            self.__cache[name] = data
+            if len(self.__cache) > self.__max_cached:
+                self.__cache.popitem(last=False)
+        return data
+
+    def __contains__(self, name) -> bool:
+        return name in self.__index
+
+    def __iter__(self):
+        return iter(list(self.__index))
+
+    def __len__(self) -> int:
+        return len(self.__index)
+
+    def read_raw(self, name: str) -> bytes:
+        """Returns the member still encrypted, as it is in the zip"""
+        return self.__zip.read(name)
+
+    def close(self) -> None:
+        self.__cache.clear()
+        self.__zip.close()
+
+
+def _open_sqlite_bytes(data: bytes) -> tuple:
+    """Opens a SQLite database from its raw bytes, without touching the disk when possible.
+
+    Returns:
+        tuple: (connection, temporary file or None), the temporary file is only used
+        by the fallback and must be kept alive as long as the connection
+    """
+    import sqlite3
+    from tempfile import NamedTemporaryFile
+
+    # WAL databases can't be opened from memory, the header has to say "rollback journal"
+    # (bytes 18 and 19 are the read/write versions, 2 means WAL)
+    if data[18:20] == b"\x02\x02":
+        logger.debug("Database is in WAL mode, patching the header to legacy mode")
+        data = bytearray(data)
+        data[18:20] = b"\x01\x01"
+
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    try:
+        conn.deserialize(data)
+        logger.debug("Database deserialized in memory")
+        return conn, None
+    except (AttributeError, sqlite3.Error) as e:
+        # python < 3.11 or sqlite built without SQLITE_ENABLE_DESERIALIZE
+        logger.debug(
+            f"sqlite3 deserialize is not available ({e}), using a read-only temporary file"
+        )
+        conn.close()
 
-            # write the hash file
-            zipf.writestr(
-                "hash", md5(json.dumps(backup_file).encode("utf-8")).hexdigest().encode("utf-8")
-            )
+    tmp = NamedTemporaryFile()
+    tmp.write(data)
+    tmp.flush()
+    conn = sqlite3.connect(
+        f"file:{quote(tmp.name)}?mode=ro&immutable=1", uri=True, check_same_thread=False
+    )
+    return conn, tmp
 
-    def export_all_files(self, path: str) -> None:
-        # make the dir if not exists
-        os.makedirs(path, exist_ok=True)
-        for name in self.backup.keys():
-            with open(os.path.join(path, name), "wb") as f:
-                logger.debug(f"Writing {os.path.join(path, name)}")
-                f.write(self.backup[name])
 
-    def get_top_songs_alltime(self, n: int = 0) -> list:
-        """
-        returns a list of dict object with top n songs, by the number of times it was listened to
-        """
-        if n >= 1:
-            sql = f'SELECT * FROM "TABLE_SONGS" ORDER BY "COL_NUM_PLAYED" DESC LIMIT {n};'
-        elif n == 0:
-            sql = 'SELECT * FROM "TABLE_SONGS" ORDER BY "COL_NUM_PLAYED" DESC;'
-        else:
-            raise ValueError("Value of n cannot be negative!")
+class PathNormalizer:
+    """Turns the three kinds of paths stored by Musicolet (file://, content:// and musicolet://)
+    into a relative path like "Music/xxx/yyy/zzz/01.opus".
+    Results are memoized (bounded LRU), the same song is in a lot of playlists. The common cases
+    are handled with plain string operations, anything unusual goes through urllib.
+    """
 
-        logger.debug(f"Running '{sql}' on 'DB_SONGS_LOG'...")
-        self.__maindb_cursor.execute(sql)
+    def __init__(self, maxsize: int = 65536):
+        self.__memo = lru_cache(maxsize=maxsize)(self.__normalize)
 
-        # results as a list of dict, parsing the path is probably overkill here,
-        # since "COL_LOGPATH" has clean paths but I want paths to be consitent with playlists
-        return [
-            {**dict(row), "COL_PATH": MusicoletBackup.__parse_path(row["COL_PATH"])}
-            for row in self.__maindb_cursor.fetchall()
-        ]
+    def __call__(self, path: str) -> str:
+        return self.__memo(path)
 
-    def get_top_songs_alltime_by_time(self, n: int = 0) -> list:
-        """
-        returns a list of dict object with the top n songs, accounts for the length of the songs
-        """
-        if n >= 1:
-            sql = f"""
-            SELECT * FROM "TABLE_SONGS" 
-            ORDER BY ("COL_NUM_PLAYED" * "COL_DURATION") DESC 
-            LIMIT {n};
-            """
-        elif n == 0:
-            sql = """
-            SELECT * FROM "TABLE_SONGS" 
-            ORDER BY ("COL_NUM_PLAYED" * "COL_DURATION") DESC;
-            """
-        else:
-            raise ValueError("Value of n cannot be negative!")
+    def normalize_many(self, paths) -> list:
+        """Normalizes a whole column of paths at once"""
+        memo = self.__memo
+        return [memo(path) for path in paths]
 
-        logger.debug(f"Running '{sql}' on 'DB_SONGS_LOG'...")
-        self.__maindb_cursor.execute(sql)
+    def cache_info(self):
+        return self.__memo.cache_info()
 
-        # results as a list of dict, parsing the path is probably overkill here,
-        # since "COL_LOGPATH" has clean paths but I want paths to be consitent with playlists
-        return [
-            {**dict(row), "COL_PATH": MusicoletBackup.__parse_path(row["COL_PATH"])}
-            for row in self.__maindb_cursor.fetchall()
-        ]
+    @staticmethod
+    def __normalize(path: str) -> str:
+        # urllib would strip these or cut the path there, let it deal with them
+        if "#" in path or "\t" in path or "\r" in path or "\n" in path:
+            return PathNormalizer.parse_url(path)
+
+        if path.startswith("file://"):
+            # netloc is everything up to the next "/", empty for file:///...
+            rest = path[7:]
+            if "?" not in rest:
+                slash = rest.find("/")
+                url_path = rest[slash:] if slash != -1 else ""
+                return unquote(url_path.split("/storage/emulated/0/")[-1])
+        elif path.startswith("content://"):
+            rest = path[10:]
+            if "?" not in rest:
+                slash = rest.find("/")
+                url_path = rest[slash:] if slash != -1 else ""
+                return unquote(url_path).split("document/primary:")[-1]
+        elif path.startswith("musicolet://"):
+            # same rules as parse_qs(): first non empty value wins, '+' is a space
+            query_start = path.find("?")
+            if query_start != -1:
+                folder = file = None
+                for pair in path[query_start + 1 :].split("&"):
+                    key, sep, value = pair.partition("=")
+                    if not sep or not value:
+                        continue
+                    key = unquote(key.replace("+", " "))
+                    if key == "p_rp" and folder is None:
+                        folder = unquote(value.replace("+", " "))
+                    elif key == "p_dn" and file is None:
+                        file = unquote(value.replace("+", " "))
+                if folder is not None and file is not None:
+                    return f"{folder.strip()}/{file.strip()}"
+
+        return PathNormalizer.parse_url(path)
 
     @staticmethod
-    def __parse_path(path: str) -> str:
+    def parse_url(path: str) -> str:
+        """Reference implementation with urllib, used when the fast paths can't handle the url"""
         # logger.debug(f"Parsing the url {path}")
         url = urlparse(path)
         # we unquote at the end because for the musicolet:// scheme parse_qs() would fail if the path has '&' chars
@@ -192,44 +383,428 @@ class MusicoletBackup:
         else:
             raise Exception(f"Unexpected '{url.scheme}' url scheme!")
 
-    def __parse_playlist(self, filename: str) -> list:
+
+class PlaylistSong:
+    """View on one song of a Playlist, behaves like the old dict (song["path"], song.get("artist"))"""
+
+    __slots__ = ("__playlist", "__index")
+
+    def __init__(self, playlist, index: int):
+        self.__playlist = playlist
+        self.__index = index
+
+    def __getitem__(self, key: str):
+        column = self.__playlist.column(key)
+        if column is None:
+            raise KeyError(key)
+        return column[self.__index]
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> list:
+        return self.__playlist.keys()
+
+    def as_dict(self) -> dict:
+        return {key: self[key] for key in self.keys()}
+
+    def __repr__(self) -> str:
+        return f"PlaylistSong({self.as_dict()})"
+
+
+class Playlist(Sequence):
+    """A parsed playlist, kept in columns like Musicolet stores it (S_P, S_T, S_AL, S_D).
+    Strings are interned (the same songs are in a lot of playlists), durations are in an array
+    and paths are only normalized when they are used. Songs are PlaylistSong views created on demand.
+    """
+
+    # song key -> attribute with the column
+    _COLUMNS = {
+        "path": "paths",
+        "title": "titles",
+        "album": "albums",
+        "duration": "durations",
+        "artist": "artists",
+        "plays": "plays",
+    }
+
+    def __init__(self, raw_paths: list, titles: list, albums: list, durations: list, normalizer):
+        self.__raw_paths = [_intern(path) for path in raw_paths]
+        self.titles = [_intern(title) for title in titles]
+        self.albums = [_intern(album) for album in albums]
+        try:
+            self.durations = array("q", durations)
+        except (TypeError, OverflowError):
+            # not only ints (null or floats), keep the list
+            self.durations = list(durations)
+        self.__normalizer = normalizer
+        self.__paths = None
+        # only set by enrich()
+        self.artists = None
+        self.plays = None
+
+    @property
+    def paths(self) -> list:
+        if self.__paths is None:
+            self.__paths = self.__normalizer.normalize_many(self.__raw_paths)
+        return self.__paths
+
+    def column(self, key: str):
+        """The list of a key for every song ("path" -> paths), None if there is no such column"""
+        attribute = self._COLUMNS.get(key)
+        return getattr(self, attribute) if attribute is not None else None
+
+    def keys(self) -> list:
+        keys = ["path", "title", "album", "duration"]
+        if self.artists is not None:
+            keys += ["artist", "plays"]
+        return keys
+
+    def enrich(self, song_index: dict) -> None:
+        """Adds the "artist" and "plays" columns from MusicoletBackup.song_index (None if not found)"""
+        infos = [song_index.get(path) for path in self.paths]
+        self.artists = [info["artist"] if info else None for info in infos]
+        self.plays = [info["plays"] if info else None for info in infos]
+
+    def as_dicts(self) -> list:
+        """The old format, a list of dict [{"path": p, "title": t, "album": a, "duration": d}]"""
+        columns = [self.column(key) for key in self.keys()]
+        return [dict(zip(self.keys(), values)) for values in zip(*columns)]
+
+    def __len__(self) -> int:
+        return len(self.__raw_paths)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [PlaylistSong(self, i) for i in range(len(self))[index]]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("playlist index out of range")
+        return PlaylistSong(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield PlaylistSong(self, i)
+
+
+def _intern(value):
+    return intern(value) if isinstance(value, str) else value
+
+
+class MusicoletBackup:
+    def __init__(
+        self, backup_path: str, cache_dir: str = None, cache_size: int = DEFAULT_CACHE_SIZE
+    ):
         """
-        Returns a list of dict [{"path": p, "title": t, "album": a, "duration": d}]
+        Args:
+            backup_path (str): path of the backup zip
+            cache_dir (str): keep the decrypted files in this dir for the next runs, see default_cache_dir()
+            cache_size (int): size limit of the cache in bytes, least recently used backups are evicted
+        """
+        self.__cache_dir = cache_dir
+        self.__cache_size = cache_size
+
+        # nothing is decrypted here, members are decrypted when they are needed
+        self.backup = LazyBackupMembers(backup_path, cache_dir=cache_dir)
+        self.__paths = PathNormalizer()
+
+        # the database is only opened when a query needs it
+        self.__maindb_conn = None
+        self.__maindb_file = None
+        self.__maindb_lock = threading.Lock()
+        self.__song_columns_cache = None
+        self.__summary = None
+        self.__song_index = None
+        self.__song_index_lock = threading.Lock()
+
+    @property
+    def __db(self):
+        with self.__maindb_lock:
+            if self.__maindb_conn is None:
+                self.__maindb_conn, self.__maindb_file = self.__open_database()
+            return self.__maindb_conn
+
+    def __open_database(self) -> tuple:
+        import sqlite3
+
+        db_cache_path = self.backup.cache_path("DB_SONGS_LOG")
+        if db_cache_path is not None and os.path.exists(db_cache_path):
+            # already decrypted by a previous run, the database is opened directly
+            logger.debug(f"Opening the cached database '{db_cache_path}'")
+            conn = sqlite3.connect(
+                f"file:{quote(db_cache_path)}?mode=ro&immutable=1",
+                uri=True,
+                check_same_thread=False,
+            )
+            tmp = None
+        else:
+            conn, tmp = _open_sqlite_bytes(self.backup["DB_SONGS_LOG"])
+        conn.row_factory = sqlite3.Row
+        return conn, tmp
+
+    def close(self) -> None:
+        logger.debug("closing the database and the backup...")
+        if self.__maindb_conn is not None:
+            self.__maindb_conn.close()
+        if self.__maindb_file is not None:
+            self.__maindb_file.close()
+        if self.backup.cache_entry is not None:
+            try:
+                prune_cache(
+                    self.__cache_dir,
+                    self.__cache_size,
+                    keep=os.path.basename(self.backup.cache_entry),
+                )
+            except OSError as e:
+                logger.warning(f"Could not prune the cache: {e}")
+        self.backup.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @staticmethod
+    def encrypt_backup(dirpath: str, outpath: str, jobs: int = 1):
+        """This function can be used to create a valid Musicolet backup zip from a decrypted
+        backup. Note: for now it does NOT support adding files to the backup!!
+        Files are streamed in chunks straight into the zip, memory usage does not depend
+        on the size of the backup.
+
+        Args:
+            dirpath (str): path of the decrypted backup dir
+            outpath (str): path of the zip
+            jobs (int): number of processes used to encrypt the chunks
+        """
+        # ----- validation pass, nothing is read except "0.musicolet.backup"
+        backup_file_path = os.path.join(dirpath, "0.musicolet.backup")
+        if not os.path.isfile(backup_file_path):
+            raise Exception("there is no '0.musicolet.backup' file!")
+
+        with open(backup_file_path, "rb") as f:
+            backup_file = json.loads(f.read())
+
+        filepaths = {}
+        for root, _, files in os.walk(dirpath):
+            for file in files:
+                filepath = os.path.join(root, file)
+                relpath = os.path.relpath(filepath, dirpath)
+                if relpath != "0.musicolet.backup":
+                    filepaths[relpath] = filepath
+
+        for file in backup_file["md5"].keys():
+            if file not in filepaths:
+                raise Exception(
+                    f"File '{file}' is present in '0.musicolet.backup' but not in the dir!"
+                )
+
+        # ----- hashing and encryption, chunk by chunk
+        digests = {}
+
+        def chunks():
+            # md5 is computed here on the clear data, the encryption is done by _map()
+            for relpath, filepath in filepaths.items():
+                digest = md5()
+                with open(filepath, "rb") as f:
+                    chunk = f.read(ENCRYPTION_CHUNK_SIZE)
+                    while True:
+                        digest.update(chunk)
+                        next_chunk = f.read(ENCRYPTION_CHUNK_SIZE)
+                        # the last chunk (maybe empty) is the one that gets the padding
+                        yield relpath, chunk, not next_chunk
+                        if not next_chunk:
+                            break
+                        chunk = next_chunk
+                digests[relpath] = digest.hexdigest()
+
+        def new_member(name: str, size: int):
+            zinfo = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.external_attr = 0o600 << 16
+            return zipf.open(zinfo, "w", force_zip64=size + BLOCK_SIZE >= zipfile.ZIP64_LIMIT)
+
+        with zipfile.ZipFile(outpath, "w", zipfile.ZIP_DEFLATED) as zipf:
+            member = None
+            for relpath, encrypted, last in _map(_encrypt_chunk, chunks(), jobs):
+                if member is None:
+                    logger.debug(f"adding {relpath} in the {outpath} zipfile.")
+                    member = new_member(relpath, os.path.getsize(filepaths[relpath]))
+                member.write(encrypted)
+                if last:
+                    member.close()
+                    member = None
+
+            # preparing the "0.musicolet.backup" file
+            for file in backup_file["md5"].keys():
+                # replace all md5 in the "0.musicolet.backup" file with the newly calculated ones
+                backup_file["md5"][file] = digests[file]
+            backup_file_data = json.dumps(backup_file).encode("utf-8")
+
+            zipf.writestr("0.musicolet.backup", _encrypt_file(backup_file_data))
+            # write the hash file
+            zipf.writestr("hash", md5(backup_file_data).hexdigest().encode("utf-8"))
+
+    def export_all_files(self, path: str, jobs: int = 1) -> None:
+        # make the dir if not exists
+        os.makedirs(path, exist_ok=True)
+        names = list(self.backup.keys())
+        decrypted = _map(_try_decrypt_file, (self.backup.read_raw(name) for name in names), jobs)
+        for name, (data, error) in zip(names, decrypted):
+            if error is not None:
+                # note: the hash file is the only one that should fail, it is not encrypted
+                logger.error(f"Decryption failed for file '{name}': {error}")
+                continue
+
+            # members can be in subdirectories
+            os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+            with open(os.path.join(path, name), "wb") as f:
+                logger.debug(f"Writing {os.path.join(path, name)}")
+                f.write(data)
+
+    def iter_top_songs(
+        self, n: int = 0, columns: list = None, order_by: str = "plays", batch_size: int = 500
+    ):
+        """
+        yields the top n songs one dict at a time, rows are fetched in batches so memory
+        usage does not depend on the size of the library
+
+        Args:
+            n (int): number of songs, 0 for all of them
+            columns (list): columns of "TABLE_SONGS" to return, all of them if None
+            order_by (str): sort key, one of TOP_SONGS_ORDER ("plays", "time", "plays_year"...)
+            batch_size (int): number of rows fetched at once
+        """
+        if n < 0:
+            raise ValueError("Value of n cannot be negative!")
+        if order_by not in TOP_SONGS_ORDER:
+            raise ValueError(f"Cannot sort songs by '{order_by}'!")
+
+        if columns is None:
+            projection = "*"
+        else:
+            unknown = set(columns) - set(self.__song_columns)
+            if unknown:
+                raise ValueError(f"Unknown columns in 'TABLE_SONGS': {unknown}")
+            projection = ", ".join(f'"{column}"' for column in columns)
+
+        sql = f'SELECT {projection} FROM "TABLE_SONGS" ORDER BY {TOP_SONGS_ORDER[order_by]} DESC'
+        params = ()
+        if n >= 1:
+            sql += " LIMIT ?"
+            params = (n,)
+
+        logger.debug(f"Running '{sql}' with {params} on 'DB_SONGS_LOG'...")
+        # a new cursor every time, so multiple streams can be consumed at the same time
+        cursor = self.__db.cursor()
+        cursor.execute(sql, params)
+        try:
+            while rows := cursor.fetchmany(batch_size):
+                # parsing the path is probably overkill here, since "COL_LOGPATH" has clean paths
+                # but I want paths to be consitent with playlists
+                if "COL_PATH" in rows[0].keys():
+                    paths = self.__paths.normalize_many(row["COL_PATH"] for row in rows)
+                    for row, path in zip(rows, paths):
+                        yield {**dict(row), "COL_PATH": path}
+                else:
+                    for row in rows:
+                        yield dict(row)
+        finally:
+            cursor.close()
+
+    def get_top_songs_alltime(self, n: int = 0) -> list:
+        """
+        returns a list of dict object with top n songs, by the number of times it was listened to
+        """
+        return list(self.iter_top_songs(n, order_by="plays"))
+
+    def get_top_songs_alltime_by_time(self, n: int = 0) -> list:
+        """
+        returns a list of dict object with the top n songs, accounts for the length of the songs
+        """
+        return list(self.iter_top_songs(n, order_by="time"))
+
+    @property
+    def __song_columns(self) -> list:
+        if self.__song_columns_cache is None:
+            self.__song_columns_cache = [
+                row["name"] for row in self.__db.execute('PRAGMA table_info("TABLE_SONGS");')
+            ]
+        return self.__song_columns_cache
+
+    def __parse_playlist(self, filename: str, enrich: bool = False) -> Playlist:
+        """
+        Returns a Playlist, songs can be used like dict {"path": p, "title": t, "album": a, "duration": d}
+        with enrich=True, "artist" and "plays" are added from the database (None if the song is not in it)
         the default format is ungodly awful,
-        first we need to create a list in a more sensible format
         however there is THREE ways that paths are stored: file:// content:// and musicolet://
         aaaaAAAAaaaaAAaaaaaAAaaAAaaAAAAAAAaaaAaaaAAaaaAAAaa
         """
         logger.info(f"Parsing playlist file '{filename}'...")
         raw = json.loads(self.backup[filename])
 
-        formatted = [
-            {"path": MusicoletBackup.__parse_path(p), "title": t, "album": a, "duration": d}
-            for p, t, a, d in zip(
-                raw["S_P"],
-                raw["S_T"],
-                raw["S_AL"],
-                raw["S_D"],
-            )
-        ]
+        playlist = Playlist(raw["S_P"], raw["S_T"], raw["S_AL"], raw["S_D"], self.__paths)
+        if enrich:
+            playlist.enrich(self.song_index)
 
-        return formatted
+        return playlist
+
+    @property
+    def song_index(self) -> dict:
+        """
+        normalized path -> {"artist", "plays", "plays_year", "plays_month", "plays_week", "duration"}
+        for every song of "TABLE_SONGS", built once so playlists can be joined with the database
+        without a query per song
+        """
+        with self.__song_index_lock:
+            if self.__song_index is not None:
+                return self.__song_index
+
+            sql = """
+            SELECT "COL_PATH", "COL_ARTIST", "COL_NUM_PLAYED", "COL_NUM_PLAYED_Y",
+                "COL_NUM_PLAYED_M", "COL_NUM_PLAYED_W", "COL_DURATION"
+            FROM "TABLE_SONGS";
+            """
+            logger.debug(f"Running '{sql}' on 'DB_SONGS_LOG'...")
+            rows = self.__db.execute(sql).fetchall()
+
+            index = {}
+            for path, row in zip(self.__paths.normalize_many(row[0] for row in rows), rows):
+                # the same file can be in the database with different urls, first one wins
+                if path not in index:
+                    index[path] = {
+                        "artist": row[1],
+                        "plays": row[2],
+                        "plays_year": row[3],
+                        "plays_month": row[4],
+                        "plays_week": row[5],
+                        "duration": row[6],
+                    }
+            self.__song_index = index
+            return index
 
     def playlist_exists(self, name: str) -> bool:
         exist = f"{name}.mpl" in self.backup
         if not exist:
-            logging.debug(f"Playlist not found '{name}.mpl' in {self.backup.keys()}")
+            logging.debug(f"Playlist not found '{name}.mpl' in {list(self.backup.keys())}")
         return exist
 
-    def get_playlist(self, name: str) -> list:
+    def get_playlist(self, name: str, enrich: bool = False) -> Playlist:
         if not self.playlist_exists(name):
             raise FileNotFoundError(f"Playlist '{name}' does not exist!")
 
-        return self.__parse_playlist(name + ".mpl")
+        return self.__parse_playlist(name + ".mpl", enrich)
+
+    def get_favorites(self, enrich: bool = False) -> Playlist:
+        return self.__parse_playlist("0.favs", enrich)
 
     @property
-    def favorites(self) -> list:
-        return self.__parse_playlist("0.favs")
+    def favorites(self) -> Playlist:
+        return self.get_favorites()
 
     @property
     def playlists(self) -> list:
@@ -240,31 +815,58 @@ class MusicoletBackup:
                 playlists.append(split_filename[0])
         return playlists
 
+    def listening_summary(self) -> dict:
+        """
+        returns the listening time (ms) for the 4 windows ("alltime", "year", "month", "week"),
+        in total and for every artist and album, albums are keyed by (artist, album) so that albums
+        with the same name by different artists stay apart:
+        {"total": {"alltime": t, ...}, "artists": {artist: {"alltime": t, ...}},
+         "albums": {(artist, album): {"alltime": t, ...}}}
+        everything comes from one scan of "TABLE_SONGS" and is only computed once
+        """
+        if self.__summary is not None:
+            return self.__summary
+
+        sql = """
+        SELECT "COL_ARTIST", "COL_ALBUM",
+            SUM("COL_NUM_PLAYED" * "COL_DURATION"),
+            SUM("COL_NUM_PLAYED_Y" * "COL_DURATION"),
+            SUM("COL_NUM_PLAYED_M" * "COL_DURATION"),
+            SUM("COL_NUM_PLAYED_W" * "COL_DURATION")
+        FROM "TABLE_SONGS"
+        GROUP BY "COL_ARTIST", "COL_ALBUM";
+        """
+        logger.debug(f"Running '{sql}' on 'DB_SONGS_LOG'...")
+
+        windows = ("alltime", "year", "month", "week")
+        total = dict.fromkeys(windows, 0)
+        artists = {}
+        albums = {}
+        for artist, album, *times in self.__db.execute(sql):
+            artist_times = artists.setdefault(artist, dict.fromkeys(windows, 0))
+            album_times = albums.setdefault((artist, album), dict.fromkeys(windows, 0))
+            for window, time_ms in zip(windows, times):
+                time_ms = int(time_ms or 0)
+                total[window] += time_ms
+                artist_times[window] += time_ms
+                album_times[window] += time_ms
+
+        self.__summary = {"total": total, "artists": artists, "albums": albums}
+        return self.__summary
+
     @property
     def listening_time_alltime(self) -> int:
-        self.__maindb_cursor.execute(
-            "SELECT SUM(COL_NUM_PLAYED * COL_DURATION) AS time FROM TABLE_SONGS;"
-        )
-        return int(self.__maindb_cursor.fetchall()[0]["time"])
+        return self.listening_summary()["total"]["alltime"]
 
     # all of theses are very wrong
     @property
     def listening_time_year(self) -> int:
-        self.__maindb_cursor.execute(
-            "SELECT SUM(COL_NUM_PLAYED_Y * COL_DURATION) AS time FROM TABLE_SONGS;"
-        )
-        return int(self.__maindb_cursor.fetchall()[0]["time"])
+        return self.listening_summary()["total"]["year"]
 
     @property
     def listening_time_month(self) -> int:
-        self.__maindb_cursor.execute(
-            "SELECT SUM(COL_NUM_PLAYED_M * COL_DURATION) AS time FROM TABLE_SONGS;"
-        )
-        return int(self.__maindb_cursor.fetchall()[0]["time"])
+        return self.listening_summary()["total"]["month"]
 
     @property
     def listening_time_week(self) -> int:
-        self.__maindb_cursor.execute(
-            "SELECT SUM(COL_NUM_PLAYED_W * COL_DURATION) AS time FROM TABLE_SONGS;"
-        )
-        return int(self.__maindb_cursor.fetchall()[0]["time"])
+        return self.listening_summary()["total"]["week"]
@@ -0,0 +1,252 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from stat import S_ISSOCK
+
+from mscltbck import MusicoletBackup, Playlist, default_socket_path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = default_socket_path()
+
+# seconds, a server that takes longer to accept or to list its backups is stuck and the CLI loads
+# the backup itself. Requests can take longer, the first one may have to decrypt the backup
+CONNECT_TIMEOUT = 2
+REQUEST_TIMEOUT = 120
+
+# the only things a client can call on a MusicoletBackup, properties are called without arguments
+SERVED_METHODS = {
+    "playlists",
+    "playlist_exists",
+    "get_playlist",
+    "get_favorites",
+    "iter_top_songs",
+    "listening_summary",
+}
+
+
+class LoadedBackup:
+    """A MusicoletBackup kept in memory, reloaded when the zip changes on disk"""
+
+    def __init__(self, path: str, **backup_kwargs):
+        self.path = path
+        self.__backup_kwargs = backup_kwargs
+        self.__lock = threading.Lock()
+        self.__backup = None
+        self.__stat = None
+
+    def call(self, method: str, args: list, kwargs: dict):
+        with self.__lock:
+            backup = self.__load()
+            attr = getattr(backup, method)
+            result = attr(*args, **kwargs) if callable(attr) else attr
+
+            # everything has to be converted to json while we still hold the lock
+            if isinstance(result, Playlist):
+                return result.as_dicts()
+            if method == "iter_top_songs":
+                return list(result)
+            if method == "listening_summary":
+                # json objects can't have (artist, album) keys
+                return {
+                    **result,
+                    "albums": [[*key, times] for key, times in result["albums"].items()],
+                }
+            return result
+
+    def __load(self) -> MusicoletBackup:
+        stat = os.stat(self.path)
+        stat = (stat.st_size, stat.st_mtime_ns)
+        if self.__backup is None or stat != self.__stat:
+            if self.__backup is not None:
+                logger.info(f"'{self.path}' changed, reloading it")
+                self.__backup.close()
+                self.__backup = None
+            self.__backup = MusicoletBackup(self.path, **self.__backup_kwargs)
+            self.__stat = stat
+        return self.__backup
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__backup is not None:
+                self.__backup.close()
+                self.__backup = None
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    # one json request per line, one json response per line, until the client closes the socket
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = {"result": self.server.handle_request_dict(request)}
+            except Exception as e:
+                logger.debug(f"Request failed: {e!r}")
+                response = {"error": str(e), "type": type(e).__name__}
+            self.wfile.write(json.dumps(response, default=str).encode("utf-8") + b"\n")
+
+
+class BackupServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Answers MusicoletBackup queries as json over a unix socket, see RemoteBackup for the client"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, backup_paths: list, **backup_kwargs):
+        self.backups = {
+            os.path.realpath(path): LoadedBackup(path, **backup_kwargs) for path in backup_paths
+        }
+
+        # a socket file that nobody listens on is from a dead server, anything else is not ours
+        try:
+            mode = os.lstat(socket_path).st_mode
+        except FileNotFoundError:
+            mode = None
+        if mode is not None:
+            if not S_ISSOCK(mode):
+                raise FileExistsError(f"'{socket_path}' exists and is not a socket!")
+            if RemoteBackup.daemon_running(socket_path):
+                raise FileExistsError(f"A server is already listening on '{socket_path}'!")
+            os.unlink(socket_path)
+
+        # only the user can talk to the server, the backups are personal
+        old_umask = os.umask(0o077)
+        try:
+            super().__init__(socket_path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def handle_request_dict(self, request: dict):
+        if request.get("method") == "backups":
+            return list(self.backups)
+
+        method = request["method"]
+        if method not in SERVED_METHODS:
+            raise ValueError(f"Unknown method '{method}'")
+
+        backup = self.backups.get(request["backup"])
+        if backup is None:
+            raise KeyError(f"'{request['backup']}' is not served")
+
+        return backup.call(method, request.get("args", []), request.get("kwargs", {}))
+
+    def preload(self) -> None:
+        for backup in self.backups.values():
+            logger.info(f"Loading '{backup.path}'")
+            backup.call("playlists", [], {})
+
+    def server_close(self):
+        super().server_close()
+        for backup in self.backups.values():
+            backup.close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+class RemoteBackup:
+    """Same interface as MusicoletBackup (the parts used by the CLI), answered by a BackupServer.
+    Playlists come back as lists of dict.
+    """
+
+    def __init__(self, socket_path: str, backup_path: str):
+        self.__backup_path = os.path.realpath(backup_path)
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # raised as TimeoutError (an OSError), connect() gives up on the server
+        self.__sock.settimeout(CONNECT_TIMEOUT)
+        self.__sock.connect(socket_path)
+        self.__file = self.__sock.makefile("rwb")
+        # the export threads share the connection
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def daemon_running(socket_path: str) -> bool:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONNECT_TIMEOUT)
+            try:
+                sock.connect(socket_path)
+            except OSError:
+                return False
+        return True
+
+    @classmethod
+    def connect(cls, socket_path: str, backup_path: str):
+        """Returns a RemoteBackup if a server is running and serves this backup, None otherwise.
+        A server that does not answer within CONNECT_TIMEOUT is treated like no server.
+        """
+        try:
+            remote = cls(socket_path, backup_path)
+        except OSError as e:
+            logger.debug(f"Could not connect to '{socket_path}': {e}")
+            return None
+
+        try:
+            served = remote.__call("backups")
+        except (OSError, ValueError) as e:
+            logger.debug(f"Server on '{socket_path}' did not answer: {e}")
+            served = []
+        if remote.__backup_path not in served:
+            logger.debug(f"'{backup_path}' is not served by '{socket_path}'")
+            remote.close()
+            return None
+
+        logger.debug(f"Using the server on '{socket_path}'")
+        remote.__sock.settimeout(REQUEST_TIMEOUT)
+        return remote
+
+    def __call(self, method: str, *args, **kwargs):
+        request = {"backup": self.__backup_path, "method": method, "args": args, "kwargs": kwargs}
+        with self.__lock:
+            self.__file.write(json.dumps(request).encode("utf-8") + b"\n")
+            self.__file.flush()
+            line = self.__file.readline()
+        if not line:
+            raise ConnectionError("The server closed the connection")
+
+        response = json.loads(line)
+        if "error" in response:
+            # same exceptions as a local MusicoletBackup for the ones the CLI cares about
+            if response["type"] == "FileNotFoundError":
+                raise FileNotFoundError(response["error"])
+            if response["type"] == "ValueError":
+                raise ValueError(response["error"])
+            raise RuntimeError(f"{response['type']}: {response['error']}")
+        return response["result"]
+
+    @property
+    def playlists(self) -> list:
+        return self.__call("playlists")
+
+    def playlist_exists(self, name: str) -> bool:
+        return self.__call("playlist_exists", name)
+
+    def get_playlist(self, name: str, enrich: bool = False) -> list:
+        return self.__call("get_playlist", name, enrich=enrich)
+
+    def get_favorites(self, enrich: bool = False) -> list:
+        return self.__call("get_favorites", enrich=enrich)
+
+    @property
+    def favorites(self) -> list:
+        return self.get_favorites()
+
+    def iter_top_songs(self, n: int = 0, columns: list = None, order_by: str = "plays", **_):
+        return iter(self.__call("iter_top_songs", n, columns=columns, order_by=order_by))
+
+    def listening_summary(self) -> dict:
+        summary = self.__call("listening_summary")
+        summary["albums"] = {(artist, album): times for artist, album, times in summary["albums"]}
+        return summary
+
+    def close(self) -> None:
+        self.__file.close()
+        self.__sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -1,15 +1,243 @@
 #!/usr/bin/env python3
 
-from mscltbck import MusicoletBackup
+from mscltbck import MusicoletBackup, Playlist, default_cache_dir, default_socket_path
 
 import logging
 import argparse
 import os
+import re
+import signal
+import sys
+import threading
+from functools import lru_cache, partial
+from itertools import islice, repeat
 
 logger = logging.getLogger(__name__)
 
+# songs are rewritten/checked by batches when exporting
+EXPORT_BATCH_SIZE = 500
+
+# play counter used for the --period of --top/--top-time
+TOP_SONGS_PLAYS_COLUMN = {
+    "alltime": "COL_NUM_PLAYED",
+    "year": "COL_NUM_PLAYED_Y",
+    "month": "COL_NUM_PLAYED_M",
+    "week": "COL_NUM_PLAYED_W",
+}
+
+
+def top_songs_order(args) -> str:
+    # keys of mscltbck.TOP_SONGS_ORDER
+    metric = "plays" if args.top else "time"
+    return metric if args.period == "alltime" else f"{metric}_{args.period}"
+
+
+class PathRewriter:
+    """The --replace rules, compiled once.
+    Each rule is 'old,new' or 'old,new,old2,new2', rules are applied in order and the second
+    replace of a rule is only done if the first one was. One regex scan tells if any rule
+    can apply, and the result is memoized for every distinct path.
+    """
+
+    def __init__(self, rules: list, maxsize: int = 65536):
+        self.__rules = []
+        for rule in rules:
+            fields = rule.split(",")
+            if len(fields) < 2:
+                raise ValueError(f"Invalid replace rule '{rule}', expected 'old,new[,old2,new2]'")
+            second = (fields[2], fields[3]) if len(fields) == 4 else None
+            self.__rules.append((fields[0], fields[1], second))
+
+        # if none of the 'old' is in the path, no rule can change it
+        self.__any_rule = re.compile("|".join(re.escape(old) for old, _, _ in self.__rules))
+        self.__memo = lru_cache(maxsize=maxsize)(self.__rewrite)
+
+    def __call__(self, path: str) -> str:
+        return self.__memo(path) if self.__rules else path
+
+    def rewrite_many(self, paths) -> list:
+        return [self(path) for path in paths]
+
+    def __rewrite(self, path: str) -> str:
+        if self.__any_rule.search(path) is None:
+            return path
+
+        # the reason I need this is if I want a second replace
+        # applied only if the first replace is done
+        for old, new, second in self.__rules:
+            if old in path:
+                path = path.replace(old, new)
+                if second is not None:
+                    path = path.replace(*second)
+        return path
+
+
+class ExistenceChecker:
+    """os.path.exists() for --check, results are shared between all the playlists of a run.
+    With prefetch_dirs, one scandir() per directory answers every lookup of a file that is in
+    it, the remaining stats are done on a thread pool (on network mounts a stat is a round trip).
+    Can be used from multiple threads.
+    """
+
+    def __init__(self, jobs: int = 8, prefetch_dirs: bool = False):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.__executor = ThreadPoolExecutor(max_workers=jobs)
+        self.__prefetch_dirs = prefetch_dirs
+        self.__exists = {}
+        # dir -> (names, symlinks) or None if it could not be listed
+        self.__listings = {}
+        self.__lock = threading.Lock()
+        self.lookups = 0
+        self.cache_hits = 0
+        self.listing_hits = 0
+        self.stats = 0
+
+    def __call__(self, path: str) -> bool:
+        return self.check_many([path])[0]
+
+    def check_many(self, paths) -> list:
+        paths = list(paths)
+        with self.__lock:
+            todo = [path for path in dict.fromkeys(paths) if path not in self.__exists]
+            self.lookups += len(paths)
+            self.cache_hits += len(paths) - len(todo)
+
+        to_stat = todo
+        if self.__prefetch_dirs:
+            to_stat = []
+            self.__list_dirs({os.path.dirname(path) for path in todo})
+            for path in todo:
+                exists = self.__exists_from_listing(path)
+                if exists is None:
+                    to_stat.append(path)
+                else:
+                    self.__exists[path] = exists
+            with self.__lock:
+                self.listing_hits += len(todo) - len(to_stat)
+
+        if to_stat:
+            for path, exists in zip(to_stat, self.__executor.map(os.path.exists, to_stat)):
+                self.__exists[path] = exists
+            with self.__lock:
+                self.stats += len(to_stat)
+
+        return [self.__exists[path] for path in paths]
+
+    def close(self) -> None:
+        self.__executor.shutdown()
+
+    def __list_dirs(self, dirs: set) -> None:
+        dirs = [d for d in dirs if d not in self.__listings]
+        for d, listing in zip(dirs, self.__executor.map(self.__list_dir, dirs)):
+            self.__listings[d] = listing
+
+    @staticmethod
+    def __list_dir(d: str):
+        names = set()
+        symlinks = set()
+        try:
+            with os.scandir(d or ".") as entries:
+                for entry in entries:
+                    (symlinks if entry.is_symlink() else names).add(entry.name)
+        except (FileNotFoundError, NotADirectoryError):
+            # nothing can exist in there
+            return set(), set()
+        except OSError as e:
+            logger.debug(f"Could not list '{d}': {e}")
+            return None
+        return names, symlinks
+
+    def __exists_from_listing(self, path: str):
+        """True if the listing of the directory has the file, None if it has to be stat'ed"""
+        listing = self.__listings.get(os.path.dirname(path))
+        name = os.path.basename(path)
+        if listing is None or name in ("", ".", ".."):
+            return None
+        names, symlinks = listing
+        if name in symlinks:
+            # the target can be missing, os.path.exists() follows symlinks
+            return None
+        # not in the listing isn't enough to drop a song, on case-insensitive or unicode
+        # normalizing mounts (FAT, SMB, macOS) the name can be spelled differently
+        return True if name in names else None
+
+
+def song_rows(songs, keys: list):
+    """(value of every key) for every song. A Playlist is read column by column (missing columns
+    are None), the songs of a RemoteBackup are dicts
+    """
+    if isinstance(songs, Playlist):
+        columns = [songs.column(key) for key in keys]
+        return zip(*(repeat(None) if column is None else column for column in columns))
+    return (tuple(song.get(key) for key in keys) for song in songs)
+
+
+def free_m3u8_paths(output: str, names: list) -> list:
+    """Returns a m3u8 path for every playlist name, a number is added to the file
+    if it already exists (or is already used by another playlist of the list).
+    The output dir is only listed once.
+    """
+    taken = set(os.listdir(output))
+    paths = []
+    for name in names:
+        filename = name + ".m3u8"
+        number = 1
+        while filename in taken:
+            filename = name + f" ({number}).m3u8"
+            number += 1
+        taken.add(filename)
+        paths.append(os.path.join(output, filename))
+    return paths
+
+
+def export_m3u8(m3u8_path: str, songs, rewrite, check=None) -> tuple:
+    """Renders a playlist in memory and writes the m3u8 with a single write.
+
+    Args:
+        m3u8_path (str): destination
+        songs: iterable of (path, duration in ms, title, artist or None), see song_rows()
+        rewrite (PathRewriter): --replace rules
+        check (ExistenceChecker): only songs that exist are written, None to write everything
+
+    Returns:
+        tuple: (number of exported songs, number of songs)
+    """
+    exported_count = 0
+    # songs can be a generator, they are counted while rendering them
+    total_count = 0
+    lines = ["#EXTM3U\n"]  # M3U8 header
+    songs = iter(songs)
+    # paths are rewritten and checked in batches
+    while batch := list(islice(songs, EXPORT_BATCH_SIZE)):
+        total_count += len(batch)
+        paths = rewrite.rewrite_many(song[0] for song in batch)
+        exists = check.check_many(paths) if check is not None else [True] * len(batch)
+
+        for (_, duration, title, artist), path, path_exists in zip(batch, paths, exists):
+            if path_exists:
+                # it's in ms in the backup
+                duration = round(duration / 1000)
+                # "Artist - Title" is what players expect, songs not in the database only have a title
+                if artist:
+                    title = f"{artist} - {title}"
+                lines.append(f"#EXTINF:{duration},{title}\n{path}\n")
+                exported_count += 1
+            else:
+                logger.info(f"Skipping {path}")
+
+    with open(m3u8_path, "w", encoding="utf-8") as f:
+        f.write("".join(lines))
+    return exported_count, total_count
+
 
 def subc_export(args, bck: MusicoletBackup) -> int:
+    try:
+        rewrite = PathRewriter(args.replace or [])
+    except ValueError as e:
+        print(e)
+        return 1
+
     # make the output dir if it does not exist
     try:
         os.makedirs(args.output, exist_ok=True)
@@ -17,115 +245,119 @@ def subc_export(args, bck: MusicoletBackup) -> int:
         print(f"FileExistsError: {args.output} is probably a file!")
 
     # if using the subcommand "export", at least one argument must be used
-    # the 'playlists' variable is a zip with the name of playlist and the dict
+    # the 'playlists' variable is a list of (name of the playlist, function that loads the songs)
+    # so playlists are only parsed by the worker that exports them
     if args.playlist:
         if bck.playlist_exists(args.playlist):
-            playlists = zip([args.playlist], [bck.get_playlist(args.playlist)])
+            playlists = [(args.playlist, partial(bck.get_playlist, args.playlist, enrich=True))]
         else:
             print(f"Playlist '{args.playlist}' does not exist!")
             return 1
     elif args.favorites:
-        playlists = zip(["Favorites"], [bck.favorites])
+        playlists = [("Favorites", partial(bck.get_favorites, enrich=True))]
     elif args.all:
-        playlists = zip(
-            bck.playlists + ["Favorites"],
-            [bck.get_playlist(i) for i in bck.playlists] + [bck.favorites],
-        )
+        playlists = [(name, partial(bck.get_playlist, name, enrich=True)) for name in bck.playlists]
+        playlists.append(("Favorites", partial(bck.get_favorites, enrich=True)))
     elif args.top or args.top_time:
-        # if by time use get_top_songs_alltime_by_time
-        top_raw = (
-            bck.get_top_songs_alltime(args.top)
-            if args.top
-            else bck.get_top_songs_alltime_by_time(args.top_time)
-        )
-        # i need to adapt the data in the correct format for the m3u8 code to work
+
+        def top():
+            # songs are streamed from the database, only the needed columns are fetched
+            top_raw = bck.iter_top_songs(
+                args.top or args.top_time,
+                columns=["COL_PATH", "COL_DURATION", "COL_TITLE", "COL_ARTIST"],
+                order_by=top_songs_order(args),
+            )
+            # i need to adapt the data in the correct format for the m3u8 code to work
+            return (
+                (i["COL_PATH"], int(i["COL_DURATION"]), i["COL_TITLE"], i["COL_ARTIST"])
+                for i in top_raw
+            )
+
         name = (
-            f"Top {args.top} songs by listens (alltime)"
+            f"Top {args.top} songs by listens ({args.period})"
             if args.top
-            else f"Top {args.top_time} songs by time (alltime)"
+            else f"Top {args.top_time} songs by time ({args.period})"
         )
-        top = [
-            {
-                "path": i["COL_PATH"],
-                "duration": int(i["COL_DURATION"]),
-                "title": i["COL_TITLE"],
-            }
-            for i in top_raw
-        ]
-        playlists = zip([name], [top])
+        playlists = [(name, top)]
 
     else:
         # argparse shouldn't let this happen
         print("Invalid arguments for the export subcommand!")
         return 1
 
-    for cur_playlist_name, cur_playlist in playlists:
-        m3u8_path = os.path.join(args.output, cur_playlist_name + ".m3u8")
-        # add a number to the file if dest file already exists
-        if os.path.exists(m3u8_path):
-            number = 1
-            while os.path.exists(m3u8_path):
-                m3u8_path = os.path.join(args.output, cur_playlist_name + f" ({number}).m3u8")
-                number += 1
-
-        exported_count = 0
-        with open(m3u8_path, "w", encoding="utf-8") as f:
-            f.write("#EXTM3U\n")  # M3U8 header
-            for song in cur_playlist:
-                # it's in ms in the backup
-                duration = round(song["duration"] / 1000)
-                path = song["path"]
-
-                # honestly it would be better to just use a regex here
-                if args.replace:
-                    # HAHAHA I LOVE PYTHON LMAO
-                    for i in [j.split(",") for j in args.replace]:
-                        # this is so bad but who cares
-                        # the reason I need this is if I want a second replace
-                        # applied only if the first replace is done
-                        if i[0] in path:
-                            path = path.replace(i[0], i[1])
-                            if len(i) == 4:
-                                path = path.replace(i[2], i[3])
-                # if --check flag is set args.check=True, the file will have to exist
-                # to be written in the playlist
-                if not args.check or os.path.exists(path):
-                    f.write(f"#EXTINF:{duration},{song['title']}\n")
-                    f.write(f"{path}\n")
-                    exported_count += 1
-                else:
-                    logger.info(f"Skipping {path}")
+    m3u8_paths = free_m3u8_paths(args.output, [name for name, _ in playlists])
+
+    # if --check flag is set args.check=True, the file will have to exist
+    # to be written in the playlist
+    check = ExistenceChecker(jobs=args.check_jobs, prefetch_dirs=args.prefetch_dirs)
+
+    def export(job: tuple) -> tuple:
+        (_, load_songs), m3u8_path = job
+        songs = load_songs()
+        if isinstance(songs, (Playlist, list)):
+            # a playlist (a list of dict with a RemoteBackup), top() already gives rows
+            songs = song_rows(songs, ["path", "duration", "title", "artist"])
+        return export_m3u8(m3u8_path, songs, rewrite, check if args.check else None)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # playlists are independent, they are parsed and written on a pool of threads
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(export, zip(playlists, m3u8_paths))
+        for m3u8_path, (exported_count, total_count) in zip(m3u8_paths, results):
+            print(
+                f"=> Successfully exported {exported_count} songs out of {total_count} in {m3u8_path}."
+            )
+    check.close()
+
+    if args.check:
         print(
-            f"=> Successfully exported {exported_count} songs out of {len(cur_playlist)} in {m3u8_path}."
+            f"=> Checked {check.lookups} paths: {check.cache_hits} from the cache, "
+            f"{check.listing_hits} from directory listings, {check.stats} stat calls."
         )
     return 0
 
 
 def subc_print(args, bck: MusicoletBackup) -> int:
-    if args.favorites:
-        for song in bck.favorites:
-            print(song["path"] if args.paths else f"{song['title']} - {song['album']}")
-
-    if args.playlist:
-        for song in bck.get_playlist(args.playlist.strip()):
-            print(song["path"] if args.paths else f"{song['title']} - {song['album']}")
+    if args.favorites or args.playlist:
+        songs = (
+            bck.get_favorites(enrich=not args.paths)
+            if args.favorites
+            else bck.get_playlist(args.playlist.strip(), enrich=not args.paths)
+        )
+        if args.paths:
+            for (path,) in song_rows(songs, ["path"]):
+                print(path)
+        else:
+            # artist and listens come from the database, the song may not be in it
+            for plays, title, album, artist in song_rows(
+                songs, ["plays", "title", "album", "artist"]
+            ):
+                print(
+                    f"(Listens: {plays if plays is not None else '?'}) {title} - {album} - {artist or '?'}"
+                )
 
     if args.top or args.top_time:
-        # if by time use get_top_songs_alltime_by_time
-        top = (
-            bck.get_top_songs_alltime(args.top)
-            if args.top
-            else bck.get_top_songs_alltime_by_time(args.top_time)
+        top = bck.iter_top_songs(
+            args.top or args.top_time,
+            columns=[
+                "COL_PATH",
+                "COL_TITLE",
+                "COL_ALBUM",
+                "COL_ARTIST",
+                "COL_DURATION",
+                TOP_SONGS_PLAYS_COLUMN[args.period],
+            ],
+            order_by=top_songs_order(args),
         )
+        plays_column = TOP_SONGS_PLAYS_COLUMN[args.period]
         for song in top:
-            # the IS the artists here, and i COULD lookup the artist in the DB for the fav and playlists
-            # but i WON'T because i aleady committed way too much time on this project
-            minutes = round((song["COL_NUM_PLAYED"] * song["COL_DURATION"]) / 60000)
+            minutes = round((song[plays_column] * song["COL_DURATION"]) / 60000)
             # I want the info so fuck PEP8
             print(
                 song["COL_PATH"]
                 if args.paths
-                else f"(Listens: {song['COL_NUM_PLAYED']}, {minutes}min, {round(minutes/60, 1)}h) {song['COL_TITLE'] } - {song['COL_ALBUM']} - {song['COL_ARTIST']}"
+                else f"(Listens: {song[plays_column]}, {minutes}min, {round(minutes/60, 1)}h) {song['COL_TITLE'] } - {song['COL_ALBUM']} - {song['COL_ARTIST']}"
             )
 
     if args.all_playlists:
@@ -139,7 +371,33 @@ def subc_makezip(args) -> int:
         print("ERROR: Output is not a .zip!")
         return 1
 
-    MusicoletBackup.encrypt_backup(args.input, args.output)
+    MusicoletBackup.encrypt_backup(args.input, args.output, jobs=args.jobs)
+    return 0
+
+
+def subc_serve(args) -> int:
+    from mscltserve import BackupServer
+
+    try:
+        server = BackupServer(
+            args.daemon_socket,
+            [args.backup] + args.more_backups,
+            cache_dir=None if args.no_cache else args.cache_dir,
+            cache_size=args.cache_size * 1024 * 1024,
+        )
+    except FileExistsError as e:
+        print(e)
+        return 1
+    # stopped with ctrl+c or by a service manager, the socket is removed in both cases
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.preload()
+        print(f"=> Serving {len(server.backups)} backup(s) on {args.daemon_socket}")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
     return 0
 
 
@@ -151,16 +409,46 @@ def main(args) -> int:
 
     logger.debug(f"Args: {args}")
 
+    if args.jobs < 1:
+        args.jobs = os.cpu_count() or 1
+
     # makezip does not need the backup
     if args.subcommand == "makezip":
         return subc_makezip(args)
 
-    bck = MusicoletBackup(args.backup)
+    if args.subcommand == "serve":
+        return subc_serve(args)
+
+    # what the command will read from the backup: "names" (zip namelist), "members"
+    # (decrypted files) and/or "database", MusicoletBackup only loads what is used anyway
+    needs = {"members"} if args.decrypt else args.needs(args) if "needs" in args else set()
+    names_only = needs <= {"names"}
 
-    if args.decrypt:
-        bck.export_all_files(args.decrypt)
-        return 0
+    # a running server answers instead of loading the backup again,
+    # not worth it when the namelist of the zip is enough
+    if not args.decrypt and not args.no_daemon and not names_only:
+        if os.path.exists(args.daemon_socket):
+            from mscltserve import RemoteBackup
 
+            remote = RemoteBackup.connect(args.daemon_socket, args.backup)
+            if remote is not None:
+                with remote as bck:
+                    return run_subcommand(args, bck)
+
+    with MusicoletBackup(
+        args.backup,
+        # nothing gets decrypted when only the names are needed, the cache is useless
+        cache_dir=None if args.no_cache or names_only else args.cache_dir,
+        cache_size=args.cache_size * 1024 * 1024,
+    ) as bck:
+        if args.decrypt:
+            bck.export_all_files(args.decrypt, jobs=args.jobs)
+            return 0
+
+        return run_subcommand(args, bck)
+
+
+def run_subcommand(args, bck: MusicoletBackup) -> int:
     if args.subcommand == "export":
         return subc_export(args, bck)
 
@@ -189,6 +477,50 @@ if __name__ == "__main__":
         required=False,
         action="store_true",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of processes used to decrypt/encrypt the backup and threads used to export "
+        "playlists, 0 uses all cores (default: 1)",
+        required=False,
+        metavar="N",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help=f"Where decrypted backups are cached between runs (default: {default_cache_dir()})",
+        required=False,
+        metavar="dir",
+        default=default_cache_dir(),
+    )
+    parser.add_argument(
+        "--cache-size",
+        help="Size limit of the cache in MiB, least recently used backups are removed (default: 512)",
+        required=False,
+        metavar="MiB",
+        type=int,
+        default=512,
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="Do not read or write the cache",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--daemon-socket",
+        help=f"Socket of the 'serve' subcommand, used when a server is running (default: {default_socket_path()})",
+        required=False,
+        metavar="path",
+        default=default_socket_path(),
+    )
+    parser.add_argument(
+        "--no-daemon",
+        help="Do not use a running server, always load the backup",
+        required=False,
+        action="store_true",
+    )
     subparsers = parser.add_subparsers(help="Subcommands", dest="subcommand")
 
     # --------------------------------------------- Export subparser
@@ -234,6 +566,14 @@ if __name__ == "__main__":
         required=False,
         action="store_true",
     )
+    subp_export.add_argument(
+        "--period",
+        help="Listens counted for --top and --top-time (default: alltime)",
+        required=False,
+        choices=list(TOP_SONGS_PLAYS_COLUMN),
+        default="alltime",
+    )
+    subp_export.set_defaults(needs=lambda args: {"members", "database"})
     subp_export.add_argument(
         "-r",
         "--replace",
@@ -251,6 +591,21 @@ if __name__ == "__main__":
         required=False,
         action="store_true",
     )
+    subp_export.add_argument(
+        "--check-jobs",
+        help="Number of threads used to check if files exist (default: 8)",
+        required=False,
+        metavar="N",
+        type=int,
+        default=8,
+    )
+    subp_export.add_argument(
+        "--prefetch-dirs",
+        help="With --check, list every directory once instead of checking each file (files "
+        "missing from the listing are still checked one by one)",
+        required=False,
+        action="store_true",
+    )
     subp_export.add_argument(
         "output",
         help="Output dir",
@@ -301,6 +656,16 @@ if __name__ == "__main__":
         action="store_true",
     )
 
+    subp_print.add_argument(
+        "--period",
+        help="Listens counted for --top and --top-time (default: alltime)",
+        required=False,
+        choices=list(TOP_SONGS_PLAYS_COLUMN),
+        default="alltime",
+    )
+    subp_print.set_defaults(
+        needs=lambda args: {"names"} if args.all_playlists else {"members", "database"}
+    )
     subp_print.add_argument(
         "--paths",
         help="Print paths instead of names",
@@ -324,5 +689,18 @@ if __name__ == "__main__":
         help="Output zipfile",
     )
 
+    subp_serve = subparsers.add_parser(
+        name="serve",
+        description="Keep backups loaded and answer print/export queries on a unix socket",
+        help="Keep backups loaded and answer print/export queries on a unix socket",
+    )
+    subp_serve.set_defaults(needs=lambda args: {"members", "database"})
+    subp_serve.add_argument(
+        "more_backups",
+        help="Other backups to serve",
+        nargs="*",
+        metavar="backup_path",
+    )
+
     # pass the args to the main function
     exit(main(parser.parse_args()))
@@ -5,11 +5,67 @@ from mscltbck import MusicoletBackup
 import os
 import logging
 import json
+import subprocess
+import sys
+import time
 
 logger = logging.getLogger(__name__)
 
 
+# print -a has to feel instant, these are generous
+IMPORT_BUDGET = 0.15
+LIST_PLAYLISTS_BUDGET = 0.5
+
+
+# modules that only some commands need, importing them is what makes startup slow
+LAZY_MODULES = ("Crypto", "sqlite3", "concurrent.futures")
+
+# the CLI has a dash in its name, it can't be imported with an import statement
+IMPORTS = {
+    "mscltbck": "import mscltbck",
+    "musicolet-tools.py": "import importlib.util; "
+    "spec = importlib.util.spec_from_file_location('musicolet_tools', 'musicolet-tools.py'); "
+    "spec.loader.exec_module(importlib.util.module_from_spec(spec))",
+}
+
+
+def check_startup(backup_path: str) -> None:
+    for name, statement in IMPORTS.items():
+        # in a new interpreter, modules already imported here would not count
+        out = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                f"import sys, time; t = time.perf_counter(); {statement}; "
+                "print(time.perf_counter() - t); "
+                f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))",
+            ],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.splitlines()
+        import_time = float(out[0])
+        heavy = out[1] if len(out) > 1 else ""
+        print(f"import {name}: {round(import_time * 1000)}ms")
+        assert import_time < IMPORT_BUDGET, f"import {name} took {import_time}s"
+        assert not heavy, f"import {name} imported {heavy}"
+
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "musicolet-tools.py", "--no-daemon", backup_path, "print", "-a"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        check=True,
+    )
+    list_time = time.perf_counter() - start
+    print(f"print -a: {round(list_time * 1000)}ms")
+    assert list_time < LIST_PLAYLISTS_BUDGET, f"print -a took {list_time}s"
+
+
 def main() -> int:
+    check_startup(os.path.expanduser("~/Desktop/bck.zip"))
+
     bck = MusicoletBackup(os.path.expanduser("~/Desktop/bck.zip"))
     top = bck.get_top_songs_alltime(10)
     print("name\t\t\tartist\t\tlistens\tlistensY\tlistensM\tlistensW")
@@ -34,7 +90,7 @@ def main() -> int:
     print(week)
 
     with open(os.path.expanduser("~/Desktop/favs.json"), "w") as f:
-        f.write(json.dumps(bck.favorites, ensure_ascii=False))
+        f.write(json.dumps(bck.favorites.as_dicts(), ensure_ascii=False))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+from stats import channel_stats, format_duration, open_database_bytes, total_watch_time
+
+import argparse
+import random
+import sqlite3
+import time
+from heapq import nlargest
+from operator import itemgetter
+
+# what stats.py did before: three queries, two full scans of streams and the h:m:s formatting
+# done by sqlite for every channel
+OLD_QUERIES = [
+    """
+SELECT CAST(SUM(progress_time) / (1000 * 60 * 60) AS TEXT) || ':' ||
+    substr('00' || CAST((SUM(progress_time) / (1000 * 60)) % 60 AS TEXT), -2, 2) || ':' ||
+    substr('00' || CAST((SUM(progress_time) / 1000) % 60 AS TEXT), -2, 2) as total_watchtime
+FROM stream_state;
+""",
+    """
+SELECT uploader, COUNT(uploader) as videos_started, CAST(SUM(progress_time) / (1000 * 60 * 60) AS TEXT) || ':' ||
+    substr('00' || CAST((SUM(progress_time) / (1000 * 60)) % 60 AS TEXT), -2, 2) || ':' ||
+    substr('00' || CAST((SUM(progress_time) / 1000) % 60 AS TEXT), -2, 2) as channel_time
+FROM stream_state
+JOIN streams ON stream_state.stream_id = streams.uid
+GROUP BY uploader
+ORDER BY COUNT(uploader) DESC
+LIMIT ?;
+""",
+    """
+SELECT uploader, COUNT(uploader) AS videos_in_db
+FROM streams
+GROUP BY uploader
+ORDER BY COUNT(uploader) DESC
+LIMIT ?;
+""",
+]
+
+# the tables used by stats.py, as NewPipe creates them
+SCHEMA = """
+CREATE TABLE streams (uid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, service_id INTEGER NOT NULL,
+    url TEXT NOT NULL, title TEXT NOT NULL, stream_type TEXT NOT NULL, duration INTEGER NOT NULL,
+    uploader TEXT NOT NULL, uploader_url TEXT, thumbnail_url TEXT, view_count INTEGER,
+    textual_upload_date TEXT, upload_date INTEGER, is_upload_date_approximation INTEGER);
+CREATE UNIQUE INDEX index_streams_service_id_url ON streams (service_id, url);
+CREATE TABLE stream_state (stream_id INTEGER NOT NULL, progress_time INTEGER NOT NULL,
+    PRIMARY KEY(stream_id), FOREIGN KEY(stream_id) REFERENCES streams(uid)
+    ON UPDATE CASCADE ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED);
+"""
+
+
+def synthetic_database(streams: int, channels: int, seed: int = 0) -> bytes:
+    rng = random.Random(seed)
+    db = sqlite3.connect(":memory:")
+    db.executescript(SCHEMA)
+
+    # a few channels have most of the videos
+    weights = [1 / (i + 1) for i in range(channels)]
+    uploaders = rng.choices(range(channels), weights=weights, k=streams)
+    db.executemany(
+        "INSERT INTO streams (service_id, url, title, stream_type, duration, uploader, "
+        "uploader_url, thumbnail_url, view_count, textual_upload_date, upload_date, "
+        "is_upload_date_approximation) VALUES (0, ?, ?, 'VIDEO_STREAM', ?, ?, ?, ?, ?, ?, ?, 1)",
+        (
+            (
+                f"https://www.youtube.com/watch?v={i:011}",
+                f"Video {i} " + "title " * rng.randint(1, 10),
+                rng.randint(30, 7200),
+                f"Channel {uploader}",
+                f"https://www.youtube.com/channel/UC{uploader:022}",
+                f"https://i.ytimg.com/vi/{i:011}/hqdefault.jpg",
+                rng.randint(0, 10**7),
+                "3 years ago",
+                1600000000000 + i,
+            )
+            for i, uploader in enumerate(uploaders)
+        ),
+    )
+    db.executemany(
+        "INSERT INTO stream_state VALUES (?, ?)",
+        ((uid, rng.randint(0, 3600000)) for uid in range(1, streams + 1) if rng.random() < 0.6),
+    )
+    db.commit()
+    data = db.serialize()
+    db.close()
+    return data
+
+
+def old_stats(db: sqlite3.Connection, n: int) -> tuple:
+    total = db.execute(OLD_QUERIES[0]).fetchone()[0]
+    started = db.execute(OLD_QUERIES[1], (n,)).fetchall()
+    in_db = db.execute(OLD_QUERIES[2], (n,)).fetchall()
+    return total, started, in_db
+
+
+def new_stats(db: sqlite3.Connection, n: int) -> tuple:
+    # same as stats.print_stats, without the printing
+    total = format_duration(total_watch_time(db))
+    channels = channel_stats(db)
+    started = [
+        (uploader, count, format_duration(time))
+        for uploader, _, count, time in nlargest(
+            n, (c for c in channels if c[2]), key=itemgetter(2, 0)
+        )
+    ]
+    in_db = [
+        (uploader, count) for uploader, count, _, _ in nlargest(n, channels, key=itemgetter(1, 0))
+    ]
+    return total, started, in_db
+
+
+def best_time(fn, *args, runs: int = 5) -> float:
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Times stats.py's channel queries")
+    parser.add_argument("--streams", default=100000, type=int, help="Streams in the database")
+    parser.add_argument("--channels", default=5000, type=int, help="Different uploaders")
+    parser.add_argument("-n", default=10, type=int, help="Number of results in top channels")
+    args = parser.parse_args()
+
+    print(f"Generating a database with {args.streams} streams...")
+    # tmp is only set when sqlite can't deserialize, it has to live as long as db
+    db, tmp = open_database_bytes(synthetic_database(args.streams, args.channels))
+
+    assert old_stats(db, args.n) == new_stats(db, args.n), "results differ"
+
+    old = best_time(old_stats, db, args.n)
+    new = best_time(new_stats, db, args.n)
+    print(f"3 queries (before): {old * 1000:.1f}ms")
+    print(f"single scan:        {new * 1000:.1f}ms ({old / new:.2f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,235 @@
+import logging
+import os
+import sqlite3
+import zipfile
+import zlib
+from collections import deque
+from datetime import datetime
+from glob import escape, glob
+
+from stats import open_database
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+# strftime formats of the periods the deltas can be grouped by
+PERIODS = {"year": "%Y", "month": "%Y-%m", "week": "%Y-W%W", "day": "%Y-%m-%d"}
+
+# streams and stream_state have the same names and columns as in newpipe.db so the queries of
+# stats.py work on the store, stream_state keeps the furthest position seen in any backup
+_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    path TEXT NOT NULL,
+    snapshot TEXT NOT NULL,
+    ingested_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS streams (
+    uid INTEGER PRIMARY KEY,
+    service_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    uploader TEXT NOT NULL,
+    UNIQUE (service_id, url)
+);
+CREATE INDEX IF NOT EXISTS streams_uploader ON streams (uploader, uid);
+CREATE TABLE IF NOT EXISTS stream_state (
+    stream_id INTEGER PRIMARY KEY,
+    progress_time INTEGER NOT NULL
+);
+-- position of the streams in every backup, only when it went further than in the older backups
+CREATE TABLE IF NOT EXISTS states (
+    backup_id INTEGER NOT NULL,
+    stream_id INTEGER NOT NULL,
+    progress_time INTEGER NOT NULL,
+    PRIMARY KEY (stream_id, backup_id)
+) WITHOUT ROWID;
+"""
+
+_SQL_LOADED_STATES = """
+INSERT INTO states (backup_id, stream_id, progress_time)
+SELECT :backup_id, streams.uid, loaded.progress_time
+FROM temp.loaded
+JOIN streams USING (service_id, url)
+WHERE loaded.progress_time > COALESCE((
+    SELECT MAX(states.progress_time)
+    FROM states
+    JOIN backups ON backups.id = states.backup_id
+    WHERE states.stream_id = streams.uid
+        AND (backups.snapshot, backups.id) < (:snapshot, :backup_id)
+), -1);
+"""
+
+_SQL_PERIOD_DELTAS = """
+WITH furthest AS (
+    SELECT states.stream_id, backups.snapshot, backups.id,
+        MAX(states.progress_time) OVER (
+            PARTITION BY states.stream_id ORDER BY backups.snapshot, backups.id
+        ) AS progress_time
+    FROM states
+    JOIN backups ON backups.id = states.backup_id
+), deltas AS (
+    SELECT snapshot,
+        progress_time - COALESCE(LAG(progress_time) OVER stream, 0) AS watch_time,
+        LAG(progress_time) OVER stream IS NULL AS started
+    FROM furthest
+    WINDOW stream AS (PARTITION BY stream_id ORDER BY snapshot, id)
+)
+SELECT strftime(:format, snapshot) AS period, SUM(watch_time), SUM(started)
+FROM deltas
+GROUP BY period
+ORDER BY period;
+"""
+
+
+def find_backups(paths: list) -> list:
+    """Backups from a list of zips/newpipe.db, directories (their *.zip) and glob patterns"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(glob(os.path.join(escape(path), "*.zip")))
+        elif os.path.exists(path):
+            matches = [path]
+        else:
+            matches = sorted(glob(path))
+            if not matches:
+                raise FileNotFoundError(f"{path} does not exist")
+        found.extend(matches)
+    # the same backup given twice would only be skipped later
+    return list(dict.fromkeys(os.path.abspath(path) for path in found))
+
+
+def backup_key(path: str) -> tuple:
+    """(key, snapshot date) of a backup. The key is the CRC and size of newpipe.db, for a zip
+    both are in the central directory so nothing has to be read.
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path, "r") as newpipe_data:
+            info = newpipe_data.getinfo("newpipe.db")
+        return f"{info.CRC:08x}-{info.file_size}", datetime(*info.date_time)
+
+    crc = 0
+    with open(path, "rb") as file:
+        while chunk := file.read(READ_CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return f"{crc:08x}-{os.path.getsize(path)}", datetime.fromtimestamp(os.path.getmtime(path))
+
+
+def load_backup(path: str) -> list:
+    """[(service_id, url, uploader, progress_time or None)] of every stream of a backup"""
+    db, tmp = open_database(path)
+    try:
+        return db.execute(
+            "SELECT service_id, url, uploader, progress_time FROM streams "
+            "LEFT JOIN stream_state ON stream_state.stream_id = streams.uid"
+        ).fetchall()
+    finally:
+        db.close()
+        if tmp is not None:
+            tmp.close()
+
+
+class BackupStore:
+    """Streams of many NewPipe backups, deduplicated by (service_id, url), with the furthest
+    position seen for each of them. Backups are only ingested once (same newpipe.db CRC and size).
+    Works on a file or in memory (":memory:").
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_STORE_SCHEMA)
+        self.db.execute(
+            "CREATE TEMP TABLE loaded (service_id INTEGER, url TEXT, progress_time INTEGER)"
+        )
+
+    def is_ingested(self, key: str) -> bool:
+        return self.db.execute("SELECT 1 FROM backups WHERE key = ?", (key,)).fetchone() is not None
+
+    def ingest(self, path: str, key: str, snapshot: datetime, rows: list) -> None:
+        snapshot = snapshot.isoformat(" ")
+        # one transaction per backup, it is only marked as ingested with all its streams
+        with self.db:
+            backup_id = self.db.execute(
+                "INSERT INTO backups (key, path, snapshot) VALUES (?, ?, ?)", (key, path, snapshot)
+            ).lastrowid
+            self.db.executemany(
+                "INSERT INTO streams (service_id, url, uploader) VALUES (?, ?, ?) "
+                "ON CONFLICT DO NOTHING",
+                ((service_id, url, uploader) for service_id, url, uploader, _ in rows),
+            )
+
+            self.db.execute("DELETE FROM temp.loaded")
+            self.db.executemany(
+                "INSERT INTO temp.loaded VALUES (?, ?, ?)",
+                (
+                    (service_id, url, progress)
+                    for service_id, url, _, progress in rows
+                    if progress is not None
+                ),
+            )
+            self.db.execute(_SQL_LOADED_STATES, {"backup_id": backup_id, "snapshot": snapshot})
+            self.db.execute(
+                "INSERT INTO stream_state (stream_id, progress_time) "
+                "SELECT streams.uid, loaded.progress_time FROM temp.loaded "
+                "JOIN streams USING (service_id, url) WHERE true "
+                "ON CONFLICT (stream_id) DO UPDATE "
+                "SET progress_time = MAX(progress_time, excluded.progress_time)"
+            )
+        logger.info(f"Ingested {path} ({snapshot})")
+
+    def add_backups(self, paths: list, jobs: int = 1) -> int:
+        """Ingests the backups that are not in the store yet, they are read on jobs threads.
+        Returns the number of new backups.
+        """
+        new = []
+        keys = set()
+        for path in paths:
+            key, snapshot = backup_key(path)
+            # keys also catches the same backup under two names
+            if key in keys or self.is_ingested(key):
+                logger.debug(f"{path} is already in the store")
+                continue
+            keys.add(key)
+            new.append((path, key, snapshot))
+
+        if jobs <= 1:
+            for path, key, snapshot in new:
+                self.ingest(path, key, snapshot, load_backup(path))
+            return len(new)
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        # sqlite and zlib release the GIL, the inserts are done here as they come back. Only a few
+        # backups are loaded ahead so they don't all end up in memory
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            pending = deque()
+            for backup in new:
+                pending.append((backup, executor.submit(load_backup, backup[0])))
+                if len(pending) >= jobs * 2:
+                    backup, rows = pending.popleft()
+                    self.ingest(*backup, rows.result())
+            while pending:
+                backup, rows = pending.popleft()
+                self.ingest(*backup, rows.result())
+        return len(new)
+
+    def snapshots(self) -> list:
+        return [row[0] for row in self.db.execute("SELECT snapshot FROM backups ORDER BY snapshot")]
+
+    def period_deltas(self, period: str = "month") -> list:
+        """[(period, watch time in ms, videos started)], what was watched between the last backup
+        of the previous period and the last backup of this one. The first period has everything
+        watched before the first backup.
+        """
+        return self.db.execute(_SQL_PERIOD_DELTAS, {"format": PERIODS[period]}).fetchall()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
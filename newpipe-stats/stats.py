@@ -1,70 +1,198 @@
 #!/usr/bin/env python3
 
 import argparse
-import io
+import logging
+import os
 import sqlite3
-import tempfile
 import zipfile
+from sys import exit
+from heapq import nlargest
+from operator import itemgetter
+from urllib.parse import quote
 from prettytable import PrettyTable
 
-parser = argparse.ArgumentParser(description="Extract basic information out a NewPipe backup")
-parser.add_argument("path", help="NewPipe backup path")
-parser.add_argument("-n", default=10, help="Number of results in top channels")
-args = parser.parse_args()
-
-# god bless chatgpt
-sql_total_watchtime = """
-SELECT CAST(SUM(progress_time) / (1000 * 60 * 60) AS TEXT) || ':' ||
-    substr('00' || CAST((SUM(progress_time) / (1000 * 60)) % 60 AS TEXT), -2, 2) || ':' ||
-    substr('00' || CAST((SUM(progress_time) / 1000) % 60 AS TEXT), -2, 2) as total_watchtime
-FROM stream_state;
-"""
-
-sql_top_channels_time = f"""
-SELECT uploader, COUNT(uploader) as videos_started, CAST(SUM(progress_time) / (1000 * 60 * 60) AS TEXT) || ':' ||
-    substr('00' || CAST((SUM(progress_time) / (1000 * 60)) % 60 AS TEXT), -2, 2) || ':' ||
-    substr('00' || CAST((SUM(progress_time) / 1000) % 60 AS TEXT), -2, 2) as channel_time
-FROM stream_state
-JOIN streams ON stream_state.stream_id = streams.uid
-GROUP BY uploader
-ORDER BY COUNT(uploader) DESC
-LIMIT {args.n};
-"""
+logger = logging.getLogger(__name__)
 
-sql_number_videos = f"""
-SELECT uploader, COUNT(uploader) AS videos_in_db
+# one scan of streams for everything per channel, formatting is done in python for the rows that
+# are shown
+sql_channel_stats = """
+SELECT uploader,
+    COUNT(*) AS videos_in_db,
+    COUNT(stream_state.stream_id) AS videos_started,
+    COALESCE(SUM(progress_time), 0) AS watch_time
 FROM streams
-GROUP BY uploader
-ORDER BY COUNT(uploader) DESC
-LIMIT {args.n};
+LEFT JOIN stream_state ON stream_state.stream_id = streams.uid
+GROUP BY uploader;
 """
 
-with zipfile.ZipFile(args.path, "r") as newpipe_data:
-    with tempfile.TemporaryDirectory() as tempdir:
-        newpipe_data.extract("newpipe.db", tempdir)
-        db = sqlite3.connect(f"{tempdir}/newpipe.db")
-        cursor = db.cursor()
+sql_total_watchtime = "SELECT COALESCE(SUM(progress_time), 0) FROM stream_state;"
+
+
+def format_duration(ms: int) -> str:
+    """h:mm:ss, the hours are not padded and go over 24"""
+    seconds = ms // 1000
+    return f"{seconds // 3600}:{seconds // 60 % 60:02}:{seconds % 60:02}"
+
+
+def channel_stats(db: sqlite3.Connection) -> list:
+    """[(uploader, videos in db, videos started, watch time in ms)] for every channel"""
+    return db.execute(sql_channel_stats).fetchall()
+
+
+def total_watch_time(db: sqlite3.Connection) -> int:
+    return db.execute(sql_total_watchtime).fetchone()[0]
+
+
+def open_database_bytes(data: bytes) -> tuple:
+    """In-memory copy of a database, nothing is written to the disk when possible.
+    Returns (db, temporary file or None), the temporary file is only used when sqlite can't
+    deserialize and must be kept alive as long as db
+    """
+    # WAL databases can't be opened from memory, the header has to say "rollback journal"
+    # (bytes 18 and 19 are the read/write versions, 2 means WAL)
+    if data[18:20] == b"\x02\x02":
+        logger.debug("Database is in WAL mode, patching the header to legacy mode")
+        data = bytearray(data)
+        data[18:20] = b"\x01\x01"
+
+    db = sqlite3.connect(":memory:")
+    try:
+        db.deserialize(data)
+        return db, None
+    except (AttributeError, sqlite3.Error) as e:
+        # python < 3.11 or sqlite built without SQLITE_ENABLE_DESERIALIZE
+        logger.debug(f"sqlite3 deserialize is not available ({e}), using a temporary file")
+        db.close()
+
+    from tempfile import NamedTemporaryFile
+
+    tmp = NamedTemporaryFile(suffix=".db")
+    tmp.write(data)
+    tmp.flush()
+    return open_database_file(tmp.name), tmp
+
+
+def open_database_file(path: str) -> sqlite3.Connection:
+    # immutable: no locks, no journal, sqlite doesn't even look for a -wal file
+    return sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro&immutable=1", uri=True)
+
+
+def open_database(path: str) -> tuple:
+    """Opens the newpipe.db of a NewPipe backup zip, or an already extracted newpipe.db,
+    read-only either way. Returns (db, temporary file or None) like open_database_bytes()
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path, "r") as newpipe_data:
+            return open_database_bytes(newpipe_data.read("newpipe.db"))
+    return open_database_file(path), None
+
+
+def print_stats(db: sqlite3.Connection, n: int) -> None:
+    print(
+        "/!\\ Watchtimes are calculated with the saved playback positions and are not accurate.\n"
+    )
+
+    print(f"Total watchtime is {format_duration(total_watch_time(db))}.")
+
+    channels = channel_stats(db)
+
+    # Top channels time, only the channels with a started video. Ties are ordered by name
+    # descending, which is what sqlite did with ORDER BY COUNT(uploader) DESC
+    started = nlargest(n, (c for c in channels if c[2]), key=itemgetter(2, 0))
+    top_chan = PrettyTable()
+    top_chan.field_names = ["Channel", " Started Videos", "Watchtime"]
+    top_chan.add_rows(
+        [(uploader, count, format_duration(time)) for uploader, _, count, time in started]
+    )
+
+    # Number of videos in database
+    in_db = nlargest(n, channels, key=itemgetter(1, 0))
+    top_chan2 = PrettyTable()
+    top_chan2.field_names = ["Channel", "Videos in database"]
+    top_chan2.add_rows([(uploader, count) for uploader, count, _, _ in in_db])
+
+    print(top_chan, end="\n\n")
+    print(top_chan2)
+
+
+def print_deltas(deltas: list, period: str) -> None:
+    table = PrettyTable()
+    table.field_names = [period.capitalize(), "Watchtime", "Started Videos"]
+    table.add_rows([(label, format_duration(time), started) for label, time, started in deltas])
+    print(f"Watchtime per {period}, the first one has everything watched before the first backup:")
+    print(table)
+
+
+def main():
+    from npstore import PERIODS, BackupStore, find_backups
+
+    parser = argparse.ArgumentParser(description="Extract basic information out a NewPipe backup")
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        metavar="path",
+        help="NewPipe backup path (the zip or an extracted newpipe.db), directories of backups "
+        "and glob patterns work too. Several backups are merged",
+    )
+    parser.add_argument("-n", default=10, type=int, help="Number of results in top channels")
+    parser.add_argument(
+        "--period",
+        help="With several backups, the watchtime is also given per period (default: month)",
+        choices=PERIODS,
+        default="month",
+    )
+    parser.add_argument(
+        "--store",
+        help="SQLite database the backups are added to, the ones that are already in it are not "
+        "read again and the stats cover every backup in it",
+        metavar="DB",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of threads used to read the backups, 0 uses all cores (default: 0)",
+        metavar="N",
+        type=int,
+        default=0,
+    )
+    args = parser.parse_args()
+
+    if not args.paths and not args.store:
+        parser.error("a backup path is required")
+    if args.jobs < 1:
+        args.jobs = os.cpu_count() or 1
+
+    try:
+        paths = find_backups(args.paths)
+    except FileNotFoundError as e:
+        print(e)
+        exit(1)
+
+    if len(paths) == 1 and not args.store:
+        db, tmp = open_database(paths[0])
+        try:
+            print_stats(db, args.n)
+        finally:
+            db.close()
+            if tmp is not None:
+                tmp.close()
+        return
+
+    with BackupStore(args.store or ":memory:") as store:
+        new = store.add_backups(paths, jobs=args.jobs)
+        snapshots = store.snapshots()
+        if not snapshots:
+            print("No backups.")
+            exit(1)
 
         print(
-            "/!\ Watchtimes are calculated with the saved playback positions and are not accurate.\n"
+            f"{len(snapshots)} backups ({new} new), "
+            f"from {snapshots[0][:10]} to {snapshots[-1][:10]}.\n"
         )
+        print_stats(store.db, args.n)
+        print()
+        print_deltas(store.period_deltas(args.period), args.period)
+
 
-        # Total watchtime
-        cursor.execute(sql_total_watchtime)
-        total_watchtime = cursor.fetchall()[0][0]
-        print(f"Total watchtime is {total_watchtime}.")
-
-        # Top channels time
-        cursor.execute(sql_top_channels_time)
-        top_chan = PrettyTable()
-        top_chan.field_names = ["Channel", " Started Videos", "Watchtime"]
-        top_chan.add_rows(cursor.fetchall())
-
-        # Number of videos in database
-        cursor.execute(sql_number_videos)
-        top_chan2 = PrettyTable()
-        top_chan2.field_names = ["Channel", "Videos in database"]
-        top_chan2.add_rows(cursor.fetchall())
-
-        print(top_chan, end="\n\n")
-        print(top_chan2)
+if __name__ == "__main__":
+    main()
@@ -1,75 +1,176 @@
 #!/usr/bin/env python3
 
 import argparse
-import tempfile
-import zipfile
 import os
-import json
+from functools import partial
 from sys import exit
-from glob import glob
 
 # from statistics import mode
-import collections
 
 # from prettytable import PrettyTable
 
-parser = argparse.ArgumentParser(
-    description="Extract basic information out a Spotify Extended Streaming History"
-)
-parser.add_argument("-p", default="./my_spotify_data.zip", help="MyData.zip path")
-parser.add_argument("-n", default=10, help="Number of results in top")
-args = parser.parse_args()
-
-if not os.path.exists(args.p):
-    print(f"File {args.p} does not exist.")
-    exit(1)
-
-timePlayed = 0
-artists = []
-songs = []
-artist_time = {}
-song_time = {}
-
-with zipfile.ZipFile(args.p, "r") as spotify_data:
-    with tempfile.TemporaryDirectory() as tempdir:
-        spotify_data.extractall(path=tempdir)
-        json_files = glob(f"{tempdir}/MyData/*json")
-        for json_f in json_files:
-            with open(json_f, "r", encoding="utf8") as file:
-                history = json.loads(file.read())
-
-                for event in history:
-                    artist = event.get("master_metadata_album_artist_name")
-                    song = event.get("master_metadata_track_name")
-                    msplayed = int(event.get("ms_played"))
-
-                    try:
-                        artist_time[artist] += msplayed
-                    except KeyError:
-                        artist_time[artist] = msplayed
-
-                    try:
-                        song_time[f"{artist} - {song}"] += msplayed
-                    except KeyError:
-                        song_time[f"{artist} - {song}"] = msplayed
-
-                    artists.append(artist)
-                    songs.append(song)
-                    timePlayed += msplayed
-
-top_artists = collections.Counter(artist_time)
-top_songs = collections.Counter(song_time)
-
-# Get the most listened
-top_artists = top_artists.most_common(int(args.n))
-top_songs = top_songs.most_common(int(args.n))
-
-print(f"TOP {args.n} ARTISTS ({len(set(artists))} in total):")
-for artist, time_played in top_artists:
-    print(f"Artist: {artist}, Time Played: {round(time_played /3600000, 2)}h")
-
-print(f"\n\nTOP {args.n} SONGS: ({len(set(songs))} different songs, {len(songs)} in total)")
-for song, time_played in top_songs:
-    print(f"Song: {song}, Time Played: {round(time_played /3600000, 2)}h")
-
-exit(0)
+from sptfyhist import HistoryStore, aggregate_history, iter_events
+from sptfysketch import DEFAULT_MEMORY_BUDGET, ApproxHistoryAggregator
+
+
+def hours(ms) -> float:
+    return round(ms / 3600000, 2)
+
+
+def print_breakdown(title: str, rows: list) -> None:
+    print(f"{title}:")
+    for row in rows:
+        skipped = (
+            "" if row["skip_rate"] != row["skip_rate"] else f", {row['skip_rate']:.1%} skipped"
+        )
+        print(f"{row['label']}: {hours(row['ms_played'])}h, {row['plays']} plays{skipped}")
+    print("\n")
+
+
+def print_analytics(history, args) -> None:
+    print_breakdown(f"LISTENING PER {args.period.upper()}", history.by_period(args.period))
+    print_breakdown("LISTENING PER HOUR OF THE DAY (UTC)", history.by_hour())
+    print_breakdown("LISTENING PER WEEKDAY (UTC)", history.by_weekday())
+    print_breakdown("LISTENING PER PLATFORM", history.by_platform())
+
+    window = f" (over {args.window} {args.period}s)" if args.window > 1 else ""
+    print(f"TOP {args.n} ARTISTS PER {args.period.upper()}{window}:")
+    for label, top in history.rolling_top(int(args.n), args.period, args.window):
+        print(f"{label}:")
+        for artist, time_played in top:
+            print(f"    Artist: {artist}, Time Played: {hours(time_played)}h")
+
+
+def print_approx(history, args) -> None:
+    error = f"{history.distinct_error:.1%}"
+    print(f"TOP {args.n} ARTISTS (~{history.distinct_artists} ±{error} in total):")
+    for artist, time_played, max_error in history.top_artists_with_error(int(args.n)):
+        print(
+            f"Artist: {artist}, Time Played: {hours(time_played)}h "
+            f"(at most {hours(max_error)}h too high)"
+        )
+
+    print(
+        f"\n\nTOP {args.n} SONGS: (~{history.distinct_songs} ±{error} different songs, "
+        f"{history.events} in total)"
+    )
+    for (artist, song), time_played, max_error in history.top_songs_with_error(int(args.n)):
+        print(
+            f"Song: {artist} - {song}, Time Played: {hours(time_played)}h "
+            f"(at most {hours(max_error)}h too high)"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract basic information out a Spotify Extended Streaming History"
+    )
+    parser.add_argument("-p", default="./my_spotify_data.zip", help="MyData.zip path")
+    parser.add_argument("-n", default=10, help="Number of results in top")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of processes used to parse the history files, 0 uses all cores (default: 1)",
+        metavar="N",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--store",
+        help="SQLite database the history is added to, only the files that were never seen are "
+        "parsed and the results cover everything in the store (-j is not used)",
+        metavar="DB",
+    )
+    parser.add_argument(
+        "--analytics",
+        help="Listening time and skip rate per year/month, hour, weekday and platform, and the "
+        "top artists of every period (needs numpy)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--period",
+        help="Period of the --analytics breakdown and top (default: year)",
+        choices=["year", "month"],
+        default="year",
+    )
+    parser.add_argument(
+        "--window",
+        help="With --analytics, the top of every period covers the last N periods (default: 1)",
+        metavar="N",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--approx",
+        help="Approximate results in a fixed amount of memory, for histories with too many "
+        "different songs (the error bounds are printed)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        help="Memory used by --approx, in MiB (default: %(default)s)",
+        metavar="MIB",
+        type=float,
+        default=DEFAULT_MEMORY_BUDGET / 1024 / 1024,
+    )
+    args = parser.parse_args()
+
+    if args.approx and (args.store or args.analytics):
+        parser.error("--approx can't be used with --store or --analytics")
+
+    # an existing store can be queried without an export
+    if not os.path.exists(args.p) and not (args.store and os.path.exists(args.store)):
+        print(f"File {args.p} does not exist.")
+        exit(1)
+
+    if args.jobs < 1:
+        args.jobs = os.cpu_count() or 1
+
+    if args.analytics:
+        try:
+            from sptfyanalytics import HistoryColumns
+        except ImportError:
+            print("--analytics needs numpy (pip install numpy)")
+            exit(1)
+
+        if args.store:
+            with HistoryStore(args.store) as store:
+                if os.path.exists(args.p):
+                    store.ingest(args.p)
+                history = HistoryColumns.from_rows(store.iter_rows())
+        else:
+            history = HistoryColumns.from_events(iter_events(args.p))
+        print_analytics(history, args)
+        exit(0)
+
+    if args.approx:
+        aggregator = partial(ApproxHistoryAggregator, int(args.memory_budget * 1024 * 1024))
+        history = aggregate_history(args.p, jobs=args.jobs, aggregator=aggregator)
+        print_approx(history, args)
+        exit(0)
+
+    if args.store:
+        history = HistoryStore(args.store)
+        if os.path.exists(args.p):
+            history.ingest(args.p)
+    else:
+        history = aggregate_history(args.p, jobs=args.jobs)
+
+    print(f"TOP {args.n} ARTISTS ({history.distinct_artists} in total):")
+    for artist, time_played in history.top_artists(int(args.n)):
+        print(f"Artist: {artist}, Time Played: {hours(time_played)}h")
+
+    print(
+        f"\n\nTOP {args.n} SONGS: ({history.distinct_songs} different songs, "
+        f"{history.events} in total)"
+    )
+    for (artist, song), time_played in history.top_songs(int(args.n)):
+        print(f"Song: {artist} - {song}, Time Played: {hours(time_played)}h")
+
+    if args.store:
+        history.close()
+    exit(0)
+
+
+if __name__ == "__main__":
+    main()
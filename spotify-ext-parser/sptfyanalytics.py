@@ -0,0 +1,158 @@
+import logging
+from array import array
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+PERIODS = ("year", "month")
+
+
+def _codes(values: list, table: dict):
+    # categorical codes, the table maps the value to its code
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, value in enumerate(values):
+        code = table.get(value)
+        if code is None:
+            code = table[value] = len(table)
+        codes[i] = code
+    return codes
+
+
+class HistoryColumns:
+    """The listening history as numpy arrays, one item per event.
+    Artists, songs and platforms are codes, the names are in self.artists, self.songs (as
+    (artist, track)) and self.platforms. Timestamps are UTC, like in the export.
+    """
+
+    def __init__(self, ts: list, ms_played, artists: list, tracks: list, platforms: list, skipped):
+        # the exports use "2015-01-01T12:34:56Z", numpy does not want the Z
+        self.ts = np.array([t[:19] for t in ts], dtype="datetime64[s]")
+        self.ms_played = np.frombuffer(ms_played, dtype=np.int64)
+        # -1 when the export doesn't say (the oldest years)
+        self.skipped = np.frombuffer(skipped, dtype=np.int8)
+
+        artist_table = {}
+        song_table = {}
+        platform_table = {}
+        self.artist = _codes(artists, artist_table)
+        self.song = _codes(list(zip(artists, tracks)), song_table)
+        self.platform = _codes(platforms, platform_table)
+        self.artists = list(artist_table)
+        self.songs = list(song_table)
+        self.platforms = list(platform_table)
+
+    @classmethod
+    def from_events(cls, events):
+        ts, artists, tracks, platforms = [], [], [], []
+        ms_played = array("q")
+        skipped = array("b")
+        for event in events:
+            ts.append(event.get("ts") or "NaT")
+            ms_played.append(int(event.get("ms_played")))
+            artists.append(event.get("master_metadata_album_artist_name"))
+            tracks.append(event.get("master_metadata_track_name"))
+            platforms.append(event.get("platform"))
+            skip = event.get("skipped")
+            skipped.append(-1 if skip is None else int(bool(skip)))
+        return cls(ts, ms_played, artists, tracks, platforms, skipped)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """rows of (ts, ms_played, artist, track, platform, skipped), like HistoryStore.iter_rows()"""
+        ts, artists, tracks, platforms = [], [], [], []
+        ms_played = array("q")
+        skipped = array("b")
+        for row_ts, row_ms, artist, track, platform, skip in rows:
+            ts.append(row_ts or "NaT")
+            ms_played.append(row_ms)
+            artists.append(artist)
+            tracks.append(track)
+            platforms.append(platform)
+            skipped.append(-1 if skip is None else skip)
+        return cls(ts, ms_played, artists, tracks, platforms, skipped)
+
+    def __len__(self) -> int:
+        return len(self.ms_played)
+
+    def period_index(self, period: str = "year"):
+        """(index of the period of every event, label of every period), from the first to the
+        last period of the history
+        """
+        if period not in PERIODS:
+            raise ValueError(f"Unknown period '{period}', expected one of {PERIODS}")
+
+        if period == "year":
+            units = self.ts.astype("datetime64[Y]").astype(np.int64)
+        else:
+            units = self.ts.astype("datetime64[M]").astype(np.int64)
+        first = units.min() if len(units) else 0
+        last = units.max() if len(units) else -1
+        unit = "Y" if period == "year" else "M"
+        labels = [str(np.datetime64(int(u), unit)) for u in range(first, last + 1)]
+        return units - first, labels
+
+    def __breakdown(self, index, labels: list) -> list:
+        size = len(labels)
+        time = np.bincount(index, weights=self.ms_played, minlength=size)
+        plays = np.bincount(index, minlength=size)
+        known = self.skipped >= 0
+        skips = np.bincount(index[known], weights=self.skipped[known], minlength=size)
+        with_skip_info = np.bincount(index[known], minlength=size)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            skip_rate = np.where(with_skip_info > 0, skips / with_skip_info, np.nan)
+
+        return [
+            {"label": label, "ms_played": int(t), "plays": int(p), "skip_rate": float(s)}
+            for label, t, p, s in zip(labels, time, plays, skip_rate)
+        ]
+
+    def by_period(self, period: str = "year") -> list:
+        """[{"label", "ms_played", "plays", "skip_rate"}] for every year or month.
+        skip_rate is nan when the export has no skip information for the period.
+        """
+        return self.__breakdown(*self.period_index(period))
+
+    def by_hour(self) -> list:
+        seconds = self.ts.astype(np.int64)
+        return self.__breakdown((seconds % 86400) // 3600, [f"{h:02}h" for h in range(24)])
+
+    def by_weekday(self) -> list:
+        # 1970-01-01 was a thursday
+        days = self.ts.astype("datetime64[D]").astype(np.int64)
+        return self.__breakdown((days + 3) % 7, WEEKDAYS)
+
+    def by_platform(self) -> list:
+        return self.__breakdown(self.platform, [str(p) for p in self.platforms])
+
+    def skip_rate(self) -> float:
+        known = self.skipped >= 0
+        return float(self.skipped[known].mean()) if known.any() else float("nan")
+
+    def rolling_top(self, n: int = 10, period: str = "year", window: int = 1, by: str = "artist"):
+        """[(label, [(name, ms played)])], the top n artists (or songs with by="song") of the
+        `window` periods ending with each period
+        """
+        index, labels = self.period_index(period)
+        codes, names = (self.artist, self.artists) if by == "artist" else (self.song, self.songs)
+        size = len(names)
+
+        # one row per period, one column per artist/song
+        time = np.bincount(
+            index * size + codes, weights=self.ms_played, minlength=len(labels) * size
+        ).reshape(len(labels), size)
+        if window > 1:
+            time = time.cumsum(axis=0)
+            time[window:] -= time[:-window].copy()
+
+        result = []
+        for label, row in zip(labels, time):
+            k = min(n, size)
+            if k <= 0:
+                result.append((label, []))
+                continue
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.lexsort((top, -row[top]))]
+            result.append((label, [(names[c], int(row[c])) for c in top if row[c] > 0]))
+        return result
@@ -0,0 +1,373 @@
+import hashlib
+import io
+import json
+import logging
+import posixpath
+import re
+import zipfile
+from heapq import nlargest
+from operator import itemgetter
+from sys import intern
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DIR = "MyData"
+READ_CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+_AFTER_ITEM = re.compile(r"[ \t\n\r,\]]")
+
+
+def history_members(spotify_data: zipfile.ZipFile) -> list:
+    """Names of the MyData/*json members, the rest of the export (videos, pdfs...) is never read"""
+    members = []
+    for name in spotify_data.namelist():
+        dirname, basename = posixpath.split(name)
+        # same files as glob("MyData/*json"), which skips hidden files
+        if dirname == HISTORY_DIR and basename.endswith("json") and not basename.startswith("."):
+            members.append(name)
+    return members
+
+
+def iter_json_array(file, chunk_size: int = READ_CHUNK_SIZE):
+    """Yields the items of the json array in a text file one by one, only one item and one chunk
+    are kept in memory
+    """
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill() -> bool:
+        nonlocal buf, pos, eof
+        if eof:
+            return False
+        chunk = file.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+
+    def skip_whitespace() -> bool:
+        # False when there is nothing left to read
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buf):
+                return True
+            if not fill():
+                return False
+
+    if not skip_whitespace() or buf[pos] != "[":
+        raise ValueError("Not a json array")
+    pos += 1
+
+    first = True
+    while True:
+        if not skip_whitespace():
+            raise ValueError("Unexpected end of json array")
+        if buf[pos] == "]":
+            return
+        if not first:
+            if buf[pos] != ",":
+                raise ValueError(f"Expected ',' in json array, got '{buf[pos]}'")
+            pos += 1
+            if not skip_whitespace():
+                raise ValueError("Unexpected end of json array")
+        first = False
+
+        while True:
+            try:
+                item, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # the item is cut by the end of the chunk
+                if fill():
+                    continue
+                raise
+            # a number cut by the end of the chunk still decodes ("12" of "123", "-3" of "-3.5")
+            is_number = isinstance(item, (int, float)) and not isinstance(item, bool)
+            if is_number and not _AFTER_ITEM.match(buf, end) and fill():
+                continue
+            break
+        pos = end
+        yield item
+
+
+def iter_member_events(spotify_data: zipfile.ZipFile, name: str):
+    with spotify_data.open(name) as raw, io.TextIOWrapper(raw, encoding="utf8") as file:
+        yield from iter_json_array(file)
+
+
+def iter_events(zip_path: str):
+    """Every streaming event of a my_spotify_data.zip, file after file"""
+    with zipfile.ZipFile(zip_path, "r") as spotify_data:
+        for name in history_members(spotify_data):
+            logger.debug(f"Reading {name}")
+            yield from iter_member_events(spotify_data, name)
+
+
+class HistoryAggregator:
+    """Listening time per artist and per song, without keeping the events.
+    Memory grows with the number of different artists and tracks, not with the number of plays.
+
+    Songs are (artist id, track id) pairs, ids are indexes in self.artists and self.tracks.
+    Like the old script, "different songs" counts different track names.
+    """
+
+    def __init__(self):
+        self.artists = []
+        self.tracks = []
+        self.__artist_ids = {}
+        self.__track_ids = {}
+        # indexed by artist id
+        self.artist_time = []
+        # (artist id, track id) -> ms
+        self.song_time = {}
+        self.events = 0
+        self.time_played = 0
+
+    def __artist_id(self, artist) -> int:
+        artist_id = self.__artist_ids.get(artist)
+        if artist_id is None:
+            artist_id = len(self.artists)
+            artist = intern(artist) if artist is not None else None
+            self.__artist_ids[artist] = artist_id
+            self.artists.append(artist)
+            self.artist_time.append(0)
+        return artist_id
+
+    def __track_id(self, track) -> int:
+        track_id = self.__track_ids.get(track)
+        if track_id is None:
+            track_id = len(self.tracks)
+            track = intern(track) if track is not None else None
+            self.__track_ids[track] = track_id
+            self.tracks.append(track)
+        return track_id
+
+    def add(self, event: dict) -> None:
+        msplayed = int(event.get("ms_played"))
+        artist_id = self.__artist_id(event.get("master_metadata_album_artist_name"))
+        song = (artist_id, self.__track_id(event.get("master_metadata_track_name")))
+
+        self.artist_time[artist_id] += msplayed
+        self.song_time[song] = self.song_time.get(song, 0) + msplayed
+        self.events += 1
+        self.time_played += msplayed
+
+    def add_events(self, events) -> "HistoryAggregator":
+        for event in events:
+            self.add(event)
+        return self
+
+    def merge(self, other: "HistoryAggregator") -> "HistoryAggregator":
+        """Adds other to self. Merging the files in order gives the same result as reading them in
+        order, ties in the top N included.
+        """
+        artist_ids = [self.__artist_id(artist) for artist in other.artists]
+        track_ids = [self.__track_id(track) for track in other.tracks]
+
+        for other_id, time in enumerate(other.artist_time):
+            self.artist_time[artist_ids[other_id]] += time
+        for (artist_id, track_id), time in other.song_time.items():
+            song = (artist_ids[artist_id], track_ids[track_id])
+            self.song_time[song] = self.song_time.get(song, 0) + time
+        self.events += other.events
+        self.time_played += other.time_played
+        return self
+
+    @property
+    def distinct_artists(self) -> int:
+        return len(self.artists)
+
+    @property
+    def distinct_songs(self) -> int:
+        return len(self.tracks)
+
+    def top_artists(self, n: int) -> list:
+        """[(artist, ms played)], most listened first, first seen first on ties"""
+        top = nlargest(n, enumerate(self.artist_time), key=itemgetter(1))
+        return [(self.artists[artist_id], time) for artist_id, time in top]
+
+    def top_songs(self, n: int) -> list:
+        """[((artist, track), ms played)], most listened first, first seen first on ties"""
+        top = nlargest(n, self.song_time.items(), key=itemgetter(1))
+        return [
+            ((self.artists[artist_id], self.tracks[track_id]), time)
+            for (artist_id, track_id), time in top
+        ]
+
+
+def aggregate_member(zip_path: str, name: str, aggregator=HistoryAggregator):
+    with zipfile.ZipFile(zip_path, "r") as spotify_data:
+        return aggregator().add_events(iter_member_events(spotify_data, name))
+
+
+def aggregate_history(zip_path: str, jobs: int = 1, aggregator=HistoryAggregator):
+    """Aggregates every history file of the export, on a process pool when jobs > 1.
+    aggregator makes an empty aggregator (anything with add_events() and merge()), it has to be
+    picklable for jobs > 1.
+    """
+    with zipfile.ZipFile(zip_path, "r") as spotify_data:
+        names = history_members(spotify_data)
+
+    history = aggregator()
+    if jobs <= 1 or len(names) <= 1:
+        with zipfile.ZipFile(zip_path, "r") as spotify_data:
+            for name in names:
+                history.add_events(iter_member_events(spotify_data, name))
+        return history
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # one file per task, the partial results are merged in file order
+    with ProcessPoolExecutor(max_workers=min(jobs, len(names))) as executor:
+        partials = executor.map(
+            aggregate_member, [zip_path] * len(names), names, [aggregator] * len(names)
+        )
+        for partial in partials:
+            history.merge(partial)
+    return history
+
+
+_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    ts TEXT NOT NULL,
+    uri TEXT NOT NULL,
+    ms_played INTEGER NOT NULL,
+    artist TEXT,
+    track TEXT,
+    platform TEXT,
+    skipped INTEGER,
+    UNIQUE (ts, uri, ms_played)
+);
+CREATE INDEX IF NOT EXISTS events_artist ON events (artist, ms_played);
+CREATE INDEX IF NOT EXISTS events_song ON events (artist, track, ms_played);
+CREATE TABLE IF NOT EXISTS files (
+    hash TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    events INTEGER NOT NULL,
+    ingested_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+def _member_hash(spotify_data: zipfile.ZipFile, name: str) -> str:
+    digest = hashlib.sha1()
+    with spotify_data.open(name) as file:
+        while chunk := file.read(READ_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _event_row(event: dict) -> tuple:
+    # podcasts have no track uri, the episode is what identifies them
+    uri = event.get("spotify_track_uri") or event.get("spotify_episode_uri") or ""
+    skipped = event.get("skipped")
+    return (
+        event.get("ts") or "",
+        uri,
+        int(event.get("ms_played")),
+        event.get("master_metadata_album_artist_name"),
+        event.get("master_metadata_track_name"),
+        event.get("platform"),
+        None if skipped is None else int(bool(skipped)),
+    )
+
+
+class HistoryStore:
+    """Every event ever ingested, in a sqlite database. Exports repeat the previous years so
+    events are deduplicated on (ts, uri, ms_played) and files that were already ingested (same
+    content) are skipped entirely.
+
+    Answers the same queries as a HistoryAggregator, ties in the top N go to the first ingested.
+    """
+
+    def __init__(self, path: str):
+        import sqlite3
+
+        self.path = path
+        self.__conn = sqlite3.connect(path)
+        self.__conn.executescript(_STORE_SCHEMA)
+
+    def ingest(self, zip_path: str) -> int:
+        """Adds the history files of the export that were never seen, returns how many new events
+        were stored
+        """
+        new_events = 0
+        with zipfile.ZipFile(zip_path, "r") as spotify_data:
+            for name in history_members(spotify_data):
+                digest = _member_hash(spotify_data, name)
+                known = self.__conn.execute("SELECT 1 FROM files WHERE hash = ?", (digest,))
+                if known.fetchone():
+                    logger.debug(f"{name} was already ingested")
+                    continue
+
+                # one transaction per file, a file is only marked as ingested with all its events
+                with self.__conn:
+                    before = self.__conn.total_changes
+                    self.__conn.executemany(
+                        "INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        map(_event_row, iter_member_events(spotify_data, name)),
+                    )
+                    added = self.__conn.total_changes - before
+                    self.__conn.execute(
+                        "INSERT INTO files (hash, name, events) VALUES (?, ?, ?)",
+                        (digest, name, added),
+                    )
+                logger.info(f"{name}: {added} new events")
+                new_events += added
+        return new_events
+
+    def __scalar(self, sql: str) -> int:
+        return self.__conn.execute(sql).fetchone()[0]
+
+    @property
+    def events(self) -> int:
+        return self.__scalar("SELECT COUNT(*) FROM events")
+
+    @property
+    def time_played(self) -> int:
+        return self.__scalar("SELECT COALESCE(SUM(ms_played), 0) FROM events")
+
+    # COUNT(DISTINCT ...) would not count the events without an artist/track
+    @property
+    def distinct_artists(self) -> int:
+        return self.__scalar("SELECT COUNT(*) FROM (SELECT DISTINCT artist FROM events)")
+
+    @property
+    def distinct_songs(self) -> int:
+        return self.__scalar("SELECT COUNT(*) FROM (SELECT DISTINCT track FROM events)")
+
+    def top_artists(self, n: int) -> list:
+        return self.__conn.execute(
+            "SELECT artist, SUM(ms_played) AS time FROM events GROUP BY artist "
+            "ORDER BY time DESC, MIN(rowid) LIMIT ?",
+            (n,),
+        ).fetchall()
+
+    def top_songs(self, n: int) -> list:
+        rows = self.__conn.execute(
+            "SELECT artist, track, SUM(ms_played) AS time FROM events GROUP BY artist, track "
+            "ORDER BY time DESC, MIN(rowid) LIMIT ?",
+            (n,),
+        )
+        return [((artist, track), time) for artist, track, time in rows]
+
+    def iter_rows(self):
+        """(ts, ms_played, artist, track, platform, skipped) of every event, in ingestion order"""
+        return self.__conn.execute(
+            "SELECT ts, ms_played, artist, track, platform, skipped FROM events ORDER BY rowid"
+        )
+
+    def close(self) -> None:
+        self.__conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
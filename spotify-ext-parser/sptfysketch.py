@@ -0,0 +1,291 @@
+import math
+from array import array
+from hashlib import blake2b
+from heapq import heapify, heappop, heappush, nlargest
+from operator import itemgetter
+
+DEFAULT_MEMORY_BUDGET = 16 * 1024 * 1024
+
+# rough size of a space-saving entry: the key, its count and error and the heap entries
+_SPACE_SAVING_ENTRY_SIZE = 256
+_COUNT_MIN_DEPTH = 4
+
+
+def _digest(key) -> bytes:
+    # repr() so that None and "None" are different, blake2b so that the hash is the same in every
+    # process (the -j workers are merged)
+    return blake2b(repr(key).encode("utf-8"), digest_size=16).digest()
+
+
+class HyperLogLog:
+    """Distinct count in 2**p bytes, the standard error is 1.04 / sqrt(2**p)"""
+
+    def __init__(self, p: int = 14):
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def add_digest(self, digest: bytes) -> None:
+        x = int.from_bytes(digest[:8], "big")
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = 64 - self.p - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def add(self, key) -> None:
+        self.add_digest(_digest(key))
+
+    def merge(self, other: "HyperLogLog") -> None:
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def __len__(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        # linear counting is a lot better for small cardinalities
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class CountMinSketch:
+    """Weighted counts that are never underestimated, and overestimated by at most
+    e / width * total with a probability of 1 - e**-depth
+    """
+
+    def __init__(self, width: int, depth: int = _COUNT_MIN_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [array("q", bytes(8 * width)) for _ in range(depth)]
+        self.total = 0
+
+    def __indexes(self, digest: bytes):
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add_digest(self, digest: bytes, count: int) -> None:
+        for row, i in zip(self.rows, self.__indexes(digest)):
+            row[i] += count
+        self.total += count
+
+    def estimate_digest(self, digest: bytes) -> int:
+        return min(row[i] for row, i in zip(self.rows, self.__indexes(digest)))
+
+    def estimate(self, key) -> int:
+        return self.estimate_digest(_digest(key))
+
+    def merge(self, other: "CountMinSketch") -> None:
+        for row, other_row in zip(self.rows, other.rows):
+            for i, count in enumerate(other_row):
+                row[i] += count
+        self.total += other.total
+
+    @property
+    def error_bound(self) -> float:
+        return math.e / self.width * self.total
+
+
+class SpaceSaving:
+    """The k heaviest keys of a weighted stream (Metwally et al.), in O(k) memory.
+    Every kept count is an overestimate by at most its error, and any key heavier than
+    total / k is kept.
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self.counts = {}
+        self.errors = {}
+        # (count, seq, key) for every kept key, counts only go up so an entry can be lower than
+        # the real count, which is fixed when it gets to the top
+        self.__heap = []
+        self.__seq = 0
+
+    def __push(self, key) -> None:
+        self.__seq += 1
+        heappush(self.__heap, (self.counts[key], self.__seq, key))
+
+    def __rebuild(self) -> None:
+        self.__heap = [(count, i, key) for i, (key, count) in enumerate(self.counts.items())]
+        self.__seq = len(self.__heap)
+        heapify(self.__heap)
+
+    def __pop_min(self):
+        while True:
+            count, _, key = heappop(self.__heap)
+            if self.counts[key] == count:
+                return key, count
+            self.__push(key)
+
+    def min_count(self) -> int:
+        if len(self.counts) < self.k:
+            return 0
+        key, count = self.__pop_min()
+        self.__push(key)
+        return count
+
+    def add(self, key, count: int) -> None:
+        # a weight of 0 would only evict someone
+        if count <= 0:
+            return
+        if key in self.counts:
+            self.counts[key] += count
+            return
+        if len(self.counts) < self.k:
+            self.counts[key] = count
+            self.errors[key] = 0
+        else:
+            evicted, min_count = self.__pop_min()
+            del self.counts[evicted]
+            del self.errors[evicted]
+            self.counts[key] = min_count + count
+            self.errors[key] = min_count
+        self.__push(key)
+
+    def merge(self, other: "SpaceSaving") -> None:
+        # a key that isn't in a full summary could have up to its min count there
+        self_min = self.min_count()
+        other_min = other.min_count()
+        counts = {}
+        errors = {}
+        for key in {**self.counts, **other.counts}:
+            counts[key] = self.counts.get(key, self_min) + other.counts.get(key, other_min)
+            errors[key] = self.errors.get(key, self_min) + other.errors.get(key, other_min)
+
+        kept = nlargest(self.k, counts.items(), key=itemgetter(1))
+        self.counts = dict(kept)
+        self.errors = {key: errors[key] for key in self.counts}
+        self.__rebuild()
+
+    def top(self, n: int) -> list:
+        """[(key, count, error)], heaviest first"""
+        return [
+            (key, count, self.errors[key])
+            for key, count in nlargest(n, self.counts.items(), key=itemgetter(1))
+        ]
+
+
+class ApproxHistoryAggregator:
+    """Same results as HistoryAggregator (approximately) in a fixed amount of memory, whatever
+    the number of artists and songs. About memory_budget bytes are used, split between the
+    distinct counts (HyperLogLog), the listening time per key (Count-Min) and the heaviest keys
+    (space-saving).
+    """
+
+    def __init__(self, memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+
+        # 5% for the 2 HyperLogLog, 45% for the 2 Count-Min, 45% for the 2 space-saving and 5%
+        # for the pending plays
+        p = int(math.log2(max(16, memory_budget * 0.05 / 2)))
+        p = min(max(p, 4), 16)
+        width = max(16, int(memory_budget * 0.45 / 2 / (_COUNT_MIN_DEPTH * 8)))
+        k = max(16, int(memory_budget * 0.45 / 2 / _SPACE_SAVING_ENTRY_SIZE))
+        self.__max_pending = max(16, int(memory_budget * 0.05 / _SPACE_SAVING_ENTRY_SIZE))
+
+        self.__artists = HyperLogLog(p)
+        self.__tracks = HyperLogLog(p)
+        self.__artist_time = CountMinSketch(width)
+        self.__song_time = CountMinSketch(width)
+        self.__top_artists = SpaceSaving(k)
+        self.__top_songs = SpaceSaving(k)
+        # plays of the same song are summed before they go in the sketches, hashing is what
+        # takes time and the same songs come back a lot
+        self.__pending = {}
+        self.events = 0
+        self.time_played = 0
+
+    def add(self, event: dict) -> None:
+        msplayed = int(event.get("ms_played"))
+        song = (
+            event.get("master_metadata_album_artist_name"),
+            event.get("master_metadata_track_name"),
+        )
+        self.__pending[song] = self.__pending.get(song, 0) + msplayed
+        if len(self.__pending) >= self.__max_pending:
+            self.__flush()
+
+        self.events += 1
+        self.time_played += msplayed
+
+    def __flush(self) -> None:
+        artist_time = {}
+        for song, msplayed in self.__pending.items():
+            artist, track = song
+            artist_time[artist] = artist_time.get(artist, 0) + msplayed
+            self.__tracks.add(track)
+            self.__song_time.add_digest(_digest(song), msplayed)
+            self.__top_songs.add(song, msplayed)
+        for artist, msplayed in artist_time.items():
+            digest = _digest(artist)
+            self.__artists.add_digest(digest)
+            self.__artist_time.add_digest(digest, msplayed)
+            self.__top_artists.add(artist, msplayed)
+        self.__pending = {}
+
+    def add_events(self, events) -> "ApproxHistoryAggregator":
+        for event in events:
+            self.add(event)
+        # ready to be pickled or merged
+        self.__flush()
+        return self
+
+    def merge(self, other: "ApproxHistoryAggregator") -> "ApproxHistoryAggregator":
+        self.__flush()
+        other.__flush()
+        self.__artists.merge(other.__artists)
+        self.__tracks.merge(other.__tracks)
+        self.__artist_time.merge(other.__artist_time)
+        self.__song_time.merge(other.__song_time)
+        self.__top_artists.merge(other.__top_artists)
+        self.__top_songs.merge(other.__top_songs)
+        self.events += other.events
+        self.time_played += other.time_played
+        return self
+
+    @property
+    def distinct_artists(self) -> int:
+        self.__flush()
+        return len(self.__artists)
+
+    @property
+    def distinct_songs(self) -> int:
+        self.__flush()
+        return len(self.__tracks)
+
+    @property
+    def distinct_error(self) -> float:
+        """Relative standard error of distinct_artists and distinct_songs"""
+        return self.__artists.relative_error
+
+    def __top(self, n: int, summary: SpaceSaving, sketch: CountMinSketch) -> list:
+        self.__flush()
+        top = []
+        # both are overestimates, the smallest is the closest
+        for key, count, error in summary.top(n):
+            estimate = min(count, sketch.estimate(key))
+            # count - error is a lower bound
+            top.append((key, estimate, estimate - (count - error)))
+        top.sort(key=itemgetter(1), reverse=True)
+        return top
+
+    def top_artists_with_error(self, n: int) -> list:
+        """[(artist, ms played, max error)], the real time is between ms played - max error and
+        ms played
+        """
+        return self.__top(n, self.__top_artists, self.__artist_time)
+
+    def top_songs_with_error(self, n: int) -> list:
+        """[((artist, track), ms played, max error)]"""
+        return self.__top(n, self.__top_songs, self.__song_time)
+
+    def top_artists(self, n: int) -> list:
+        return [(artist, time) for artist, time, _ in self.top_artists_with_error(n)]
+
+    def top_songs(self, n: int) -> list:
+        return [(song, time) for song, time, _ in self.top_songs_with_error(n)]
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+from sptfyhist import HistoryAggregator
+from sptfysketch import ApproxHistoryAggregator
+
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+
+EVENTS = 200000
+ARTISTS = 20000
+TRACKS_PER_ARTIST = 20
+# small enough that the sketches can't just remember everything
+MEMORY_BUDGET = 2 * 1024 * 1024
+
+
+def synthetic_history(events: int, seed: int = 0) -> list:
+    # zipf-like, a few artists and songs get most of the plays like in a real history
+    rng = random.Random(seed)
+    artist_weights = [1 / (i + 1) for i in range(ARTISTS)]
+    track_weights = [1 / (i + 1) for i in range(TRACKS_PER_ARTIST)]
+    artists = rng.choices(range(ARTISTS), weights=artist_weights, k=events)
+    tracks = rng.choices(range(TRACKS_PER_ARTIST), weights=track_weights, k=events)
+    return [
+        {
+            "ms_played": rng.randint(0, 300000),
+            "master_metadata_album_artist_name": f"Artist {artist}",
+            "master_metadata_track_name": f"Track {artist}.{track}",
+        }
+        for artist, track in zip(artists, tracks)
+    ]
+
+
+def check_approx(exact: HistoryAggregator, approx: ApproxHistoryAggregator):
+    assert approx.events == exact.events
+
+    # 3 standard errors, this should basically never fail
+    for name, real, estimate in (
+        ("artists", exact.distinct_artists, approx.distinct_artists),
+        ("songs", exact.distinct_songs, approx.distinct_songs),
+    ):
+        error = abs(estimate - real) / real
+        print(f"distinct {name}: {real} real, {estimate} estimated ({error:.2%} off)")
+        assert error < 3 * approx.distinct_error, f"distinct {name} is {error:.2%} off"
+
+    artist_time = dict(exact.top_artists(exact.distinct_artists))
+    song_time = dict(exact.top_songs(len(exact.song_time)))
+    for name, real_times, top, real_top in (
+        ("artists", artist_time, approx.top_artists_with_error(10), exact.top_artists(10)),
+        ("songs", song_time, approx.top_songs_with_error(10), exact.top_songs(10)),
+    ):
+        # the bounds are guaranteed, not probabilistic
+        for key, estimate, max_error in top:
+            real = real_times[key]
+            assert estimate - max_error <= real <= estimate, f"{key}: {real} not in bounds"
+        found = len({key for key, *_ in top} & {key for key, _ in real_top})
+        print(f"top 10 {name}: {found}/10 found")
+        assert found >= 8, f"only {found} of the top 10 {name} found"
+
+
+def main() -> int:
+    history = synthetic_history(EVENTS)
+    exact = HistoryAggregator().add_events(history)
+
+    print("one pass:")
+    approx = ApproxHistoryAggregator(MEMORY_BUDGET).add_events(history)
+    check_approx(exact, approx)
+
+    # what -j does, one aggregator per file merged at the end
+    print("merged:")
+    merged = ApproxHistoryAggregator(MEMORY_BUDGET)
+    for i in range(0, EVENTS, EVENTS // 4):
+        merged.merge(
+            ApproxHistoryAggregator(MEMORY_BUDGET).add_events(history[i : i + EVENTS // 4])
+        )
+    check_approx(exact, merged)
+
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(funcName)s - %(message)s",
+        level=logging.DEBUG,
+    )
+    exit(main())
@@ -9,7 +9,7 @@ from prettytable import PrettyTable
 
 parser = argparse.ArgumentParser(description="Extract basic information out a usageDirect backup")
 parser.add_argument("path", help="usageDirect backup path")
-parser.add_argument("-n", default=20, help="Number of results")
+parser.add_argument("-n", default=20, type=int, help="Number of results")
 parser.add_argument(
     "-i",
     "--ignore",
@@ -18,20 +18,45 @@ parser.add_argument(
     type=str,
     required=False,
 )
+parser.add_argument(
+    "-I",
+    "--ignore-file",
+    help="Ignore the apps listed in a file, one per line (# for comments), can be repeated",
+    metavar="FILE",
+    action="append",
+    default=[],
+)
 args = parser.parse_args()
 
 # some apps, like the clock have a HUGE screen time because of always on displays
-# this is technically unsafe as it allows for SQL injection but how cares here ?
-IGNORED_APPS = (
-    ",".join([f'"{item.strip()}"' for item in ["com.android.deskclock"] + args.ignore.split(",")])
-    if args.ignore
-    else '"com.android.deskclock"'
+IGNORED_APPS = {"com.android.deskclock"}
+if args.ignore:
+    IGNORED_APPS.update(item.strip() for item in args.ignore.split(","))
+for ignore_file in args.ignore_file:
+    with open(ignore_file, "r", encoding="utf8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                IGNORED_APPS.add(line)
+
+# the ignored apps are filtered out once, the other queries only read app_time
+SQL_IGNORED_APPS = """
+CREATE TEMP TABLE ignored_apps (applicationId TEXT PRIMARY KEY) WITHOUT ROWID;
+"""
+
+SQL_APP_TIME = """
+CREATE TEMP TABLE app_time AS
+SELECT applicationId, SUM(timeUsed) AS timeUsed
+FROM usageStats
+WHERE NOT EXISTS (
+    SELECT 1 FROM temp.ignored_apps WHERE ignored_apps.applicationId = usageStats.applicationId
 )
+GROUP BY applicationId;
+"""
 
-SQL_TOTAL_TIME = f"""
+SQL_TOTAL_TIME = """
 SELECT SUM(timeUsed)
-FROM usageStats
-WHERE applicationId NOT IN  ( {IGNORED_APPS} );
+FROM temp.app_time;
 """
 
 SQL_NUMBER_OF_DAYS = """
@@ -39,18 +64,20 @@ SELECT (MAX(day) - MIN(day))
 FROM usageStats;
 """
 
-SQL_TOTAL_TIME_APPS = f"""
-SELECT applicationId, ROUND(SUM(timeUsed) / 3600000.0, 1) AS total_timeUsed
-FROM usageStats
-WHERE applicationId NOT IN ( {IGNORED_APPS} )
-GROUP BY applicationId
+SQL_TOTAL_TIME_APPS = """
+SELECT applicationId, ROUND(timeUsed / 3600000.0, 1) AS total_timeUsed
+FROM temp.app_time
 ORDER BY total_timeUsed DESC
-LIMIT {args.n};
+LIMIT ?;
 """
 
 db = sqlite3.connect(args.path)
 cursor = db.cursor()
 
+cursor.execute(SQL_IGNORED_APPS)
+cursor.executemany("INSERT INTO temp.ignored_apps VALUES (?)", ((app,) for app in IGNORED_APPS))
+cursor.execute(SQL_APP_TIME)
+
 # Total watchtime
 cursor.execute(SQL_TOTAL_TIME)
 total_screentime = int(cursor.fetchall()[0][0]) / 1000 / 60 / 60
@@ -60,7 +87,7 @@ cursor.execute(SQL_NUMBER_OF_DAYS)
 total_days = int(cursor.fetchall()[0][0])
 print(f"Days in database: {total_days}, average: {round(total_screentime/total_days, 1)}h/day")
 
-cursor.execute(SQL_TOTAL_TIME_APPS)
+cursor.execute(SQL_TOTAL_TIME_APPS, (args.n,))
 top_apps = PrettyTable()
 top_apps.field_names = ["App", "Time (h)"]
 data = cursor.fetchall()